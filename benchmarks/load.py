@@ -0,0 +1,353 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS = os.path.join(ROOT, 'benchmarks', 'results')
+sys.path.insert(0, ROOT)
+
+# Load benchmark. Drives the real command handlers with fake interactions at a fixed concurrency and
+# reports latency percentiles, throughput and event-loop lag for each command.
+#
+#   python benchmarks/load.py                                  every command, default settings
+#   python benchmarks/load.py --commands weather remind        only some commands
+#   python benchmarks/load.py --compare 1a2b3c4                compare with an earlier run
+#
+# Discord is replaced by fake interactions whose responses take --discord-latency seconds. OpenCage and
+# OpenWeatherMap are replaced by a local HTTP server that answers after --api-latency seconds, and the
+# database is a temporary SQLite file. Results are saved to benchmarks/results/<commit>.json.
+
+DEFAULT_COMMANDS = ('setlocation', 'setunit', 'weather', 'remind', 'quote', 'quotes search', '8ball', 'flip',
+                    'blackjack', 'poker', 'roulette')
+LAG_INTERVAL = 0.01
+
+# Local stand-in for OpenCage and OpenWeatherMap. It answers every place with a city in Stubland.
+
+class StubAPIHandler(BaseHTTPRequestHandler):
+    latency = 0.0
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        url = urlparse(self.path)
+        place = parse_qs(url.query).get('q', [''])[0]
+        city = place.split(',')[0].strip() or 'Nowhere'
+        if url.path.startswith('/geocode'):
+            body = {
+                'results': [{
+                    'components': {'_category': 'place', '_type': 'city', 'place': city,
+                                   'state': 'Stub State', 'country': 'Stubland'},
+                    'geometry': {'lat': random.uniform(-90, 90), 'lng': random.uniform(-180, 180)},
+                }],
+                'status': {'code': 200, 'message': 'OK'},
+                'total_results': 1,
+            }
+        else:
+            body = {'cod': 200, 'main': {'temp': round(random.uniform(-20, 35), 1)},
+                    'weather': [{'description': 'clear sky'}]}
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_stub_apis(latency):
+    handler = type('StubAPI', (StubAPIHandler,), {'latency': latency})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# Fake Discord objects. Every response, followup and player message waits for the configured latency,
+# like a round trip to Discord would.
+
+class FakeResponse:
+    def __init__(self, interaction):
+        self.interaction = interaction
+        self.done = False
+
+    def is_done(self):
+        return self.done
+
+    async def defer(self, **kwargs):
+        self.check_not_done()
+        await self.interaction.round_trip()
+        self.done = True
+
+    async def send_message(self, content=None, **kwargs):
+        self.check_not_done()
+        await self.interaction.round_trip(content)
+        self.done = True
+
+    def check_not_done(self):
+        if self.done:
+            raise RuntimeError('This interaction has already been responded to before')
+
+
+class FakeFollowup:
+    def __init__(self, interaction):
+        self.interaction = interaction
+
+    async def send(self, content=None, **kwargs):
+        if not self.interaction.response.done:
+            raise RuntimeError('Followup sent before the interaction was responded to')
+        await self.interaction.round_trip(content)
+
+
+class FakeClient:
+    # The games wait for the player's next message. Answer each prompt the way a quick player would:
+    # discard two cards, stand, and do not play again.
+    def __init__(self, interaction):
+        self.interaction = interaction
+
+    async def wait_for(self, event, check=None, timeout=None):
+        await asyncio.sleep(self.interaction.latency)
+        prompt = self.interaction.messages[-1] if self.interaction.messages else ''
+        content = 'n' if 'play again' in prompt else '1 3' if 'discard' in prompt else 's'
+        message = SimpleNamespace(content=content, author=self.interaction.user, channel=self.interaction.channel)
+        if check is not None and not check(message):
+            raise RuntimeError('The game ignored the player\'s message')
+        return message
+
+
+class FakeInteraction:
+    def __init__(self, interaction_id, user_id, guild_id, latency):
+        self.id = interaction_id
+        self.user = SimpleNamespace(id=user_id, name=f'user{user_id}', mention=f'<@{user_id}>')
+        self.guild_id = guild_id
+        self.channel_id = guild_id * 10
+        self.channel = SimpleNamespace(id=self.channel_id)
+        self.latency = latency
+        self.messages = []
+        self.client = FakeClient(self)
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup(self)
+
+    async def round_trip(self, content=None):
+        await asyncio.sleep(self.latency)
+        if content is not None:
+            self.messages.append(content)
+
+# Point the bot at the stand-ins. This has to happen before the command modules are imported, because
+# they read their settings at import time.
+
+def configure(directory, api_url):
+    os.environ['STORAGE_BACKEND'] = 'sqlite'
+    os.environ['SQLITE_PATH'] = os.path.join(directory, 'load.db')
+    os.environ['OPENCAGE_API_KEY'] = 'benchmark'
+    os.environ['OPENWEATHERMAP_API_KEY'] = 'benchmark'
+    os.environ['OPENCAGE_API_URL'] = f'{api_url}/geocode/v1/json'
+    os.environ['OPENWEATHERMAP_API_URL'] = f'{api_url}/data/2.5/weather'
+
+
+def scenarios(args):
+    from weather import weather, setlocation, setunit
+    from eightball import eightball
+    from flip import flip
+    from remind import remind
+    from quotes import quote, quotes
+    from russian_roulette import roulette
+    from card_games import blackjack, poker
+
+    cities = [f'City{n}' for n in range(args.locations)]
+    times = ['2h30m', '45 minutes', 'tomorrow 9:00', 'friday 6pm', 'every weekday 9:00']
+    words = ['beer', 'irc', 'linux', 'windows', 'coffee', 'cat']
+    search = quotes.get_command('search')
+    return {
+        'setlocation': lambda i: setlocation.callback(i, random.choice(cities), country='Stubland'),
+        'setunit': lambda i: setunit.callback(i, unit=random.choice('CFK')),
+        'weather': lambda i: weather.callback(i, location=f'{random.choice(cities)}, Stub State, Stubland'),
+        'remind': lambda i: remind.callback(i, random.choice(times), reminder='benchmark reminder'),
+        'quote': lambda i: quote.callback(i),
+        'quotes search': lambda i: search.callback(i, random.choice(words)),
+        '8ball': lambda i: eightball.callback(i, question='Will this benchmark pass?'),
+        'flip': lambda i: flip.callback(i),
+        'blackjack': lambda i: blackjack.callback(i),
+        'poker': lambda i: poker.callback(i),
+        'roulette': lambda i: roulette.callback(i),
+    }
+
+# Event-loop lag. A task that asks to wake up every LAG_INTERVAL seconds records how late it woke up.
+
+async def watch_lag(samples):
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(LAG_INTERVAL)
+        samples.append(time.perf_counter() - started - LAG_INTERVAL)
+
+
+def percentiles(values):
+    if len(values) < 2:
+        value = values[0] if values else 0.0
+        return value, value, value
+    cuts = statistics.quantiles(values, n=100, method='inclusive')
+    return cuts[49], cuts[94], cuts[98]
+
+
+async def run_command(name, handler, args, ids):
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies = []
+    errors = []
+
+    async def one():
+        async with semaphore:
+            interaction = FakeInteraction(next(ids), random.randrange(args.users) + 1,
+                                          random.randrange(args.guilds) + 1, args.discord_latency)
+            started = time.perf_counter()
+            try:
+                await handler(interaction)
+            except Exception as e:
+                errors.append(f'{type(e).__name__}: {e}')
+            latencies.append(time.perf_counter() - started)
+
+    lag = []
+    watcher = asyncio.create_task(watch_lag(lag))
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(args.requests)))
+    elapsed = time.perf_counter() - started
+    watcher.cancel()
+
+    p50, p95, p99 = percentiles(latencies)
+    lag_p50, lag_p95, lag_p99 = percentiles(lag)
+    return {
+        'requests': args.requests,
+        'errors': len(errors),
+        'first_error': errors[0] if errors else None,
+        'p50_ms': p50 * 1000,
+        'p95_ms': p95 * 1000,
+        'p99_ms': p99 * 1000,
+        'throughput': args.requests / elapsed,
+        'lag_p99_ms': lag_p99 * 1000,
+        'lag_max_ms': max(lag, default=0.0) * 1000,
+    }
+
+
+async def run(args):
+    from itertools import count
+    from storage import get_storage, close_storage
+    from quotes import seed_quotes_table, quote_sample, SAMPLE_SIZE
+
+    store = await get_storage()
+    await seed_quotes_table(store)
+    quote_sample[:] = await store.random_quotes(SAMPLE_SIZE)
+
+    handlers = scenarios(args)
+    ids = count(1)
+    results = {}
+    try:
+        for name in args.commands:
+            results[name] = await run_command(name, handlers[name], args, ids)
+    finally:
+        await close_storage()
+    return results
+
+# Results are stored per commit so runs can be compared across changes.
+
+def git_commit():
+    def git(*command):
+        return subprocess.run(['git', *command], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    try:
+        commit = git('rev-parse', '--short', 'HEAD')
+        dirty = git('status', '--porcelain', '--untracked-files=no')
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return f'{commit}-dirty' if dirty else commit
+
+
+def results_path(ref):
+    if os.path.exists(ref):
+        return ref
+    return os.path.join(RESULTS, f'{ref}.json')
+
+
+def print_report(results):
+    print(f'{"command":<16}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"req/s":>10}{"lag p99":>10}{"lag max":>10}{"errors":>8}')
+    for name, result in results.items():
+        print(f'{name:<16}{result["p50_ms"]:>10.1f}{result["p95_ms"]:>10.1f}{result["p99_ms"]:>10.1f}'
+              f'{result["throughput"]:>10.1f}{result["lag_p99_ms"]:>10.1f}{result["lag_max_ms"]:>10.1f}{result["errors"]:>8}')
+    for name, result in results.items():
+        if result['first_error']:
+            print(f'{name}: {result["errors"]} errors, first: {result["first_error"]}')
+
+
+def print_comparison(baseline, current):
+    def comparable(settings):
+        return {key: value for key, value in settings.items() if key != 'commands'}
+    if comparable(baseline['settings']) != comparable(current['settings']):
+        print('Warning: the runs used different settings, so the numbers may not be comparable.')
+    print(f'\nChange from {baseline["commit"]} to {current["commit"]}:')
+    print(f'{"command":<16}{"p50":>10}{"p99":>10}{"req/s":>10}{"lag p99":>10}')
+    for name, result in current['commands'].items():
+        before = baseline['commands'].get(name)
+        if before is None:
+            continue
+        changes = [change(before[key], result[key]) for key in ('p50_ms', 'p99_ms', 'throughput', 'lag_p99_ms')]
+        print(f'{name:<16}' + ''.join(f'{text:>10}' for text in changes))
+
+
+def change(before, after):
+    if before == 0:
+        return 'n/a'
+    return f'{(after - before) / before * 100:+.1f}%'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the command handlers against local stand-ins.')
+    parser.add_argument('--commands', nargs='+', default=list(DEFAULT_COMMANDS), choices=DEFAULT_COMMANDS,
+                        metavar='COMMAND', help='commands to run (default: all)')
+    parser.add_argument('--requests', type=int, default=500, help='invocations per command')
+    parser.add_argument('--concurrency', type=int, default=50, help='invocations in flight at once')
+    parser.add_argument('--users', type=int, default=1000, help='distinct users')
+    parser.add_argument('--guilds', type=int, default=20, help='distinct guilds')
+    parser.add_argument('--locations', type=int, default=200, help='distinct weather locations')
+    parser.add_argument('--discord-latency', type=float, default=0.05, help='seconds per Discord round trip')
+    parser.add_argument('--api-latency', type=float, default=0.1, help='seconds per OpenCage or OpenWeatherMap request')
+    parser.add_argument('--seed', type=int, default=1, help='random seed')
+    parser.add_argument('--output', help='where to save the results (default: benchmarks/results/<commit>.json)')
+    parser.add_argument('--compare', metavar='REF', help='commit or results file to compare against')
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    server = start_stub_apis(args.api_latency)
+    with tempfile.TemporaryDirectory() as directory:
+        configure(directory, f'http://127.0.0.1:{server.server_address[1]}')
+        # The handlers print debugging output for every call. Keep it out of the report.
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            results = asyncio.run(run(args))
+    server.shutdown()
+
+    settings = {key: value for key, value in vars(args).items() if key not in ('output', 'compare')}
+    current = {'commit': git_commit(), 'date': datetime.now().isoformat(timespec='seconds'),
+               'settings': settings, 'commands': results}
+    print_report(results)
+
+    output = args.output or os.path.join(RESULTS, f'{current["commit"]}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as file:
+        json.dump(current, file, indent=2)
+    print(f'\nSaved results to {output}')
+
+    if args.compare:
+        with open(results_path(args.compare)) as file:
+            print_comparison(json.load(file), current)
+
+
+if __name__ == '__main__':
+    main()
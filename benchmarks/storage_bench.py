@@ -0,0 +1,90 @@
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dotenv import load_dotenv
+from storage import MariaDBStorage, SQLiteStorage
+
+# Storage benchmark. Runs the same mix of user, reminder and quote operations against each storage
+# backend and prints the latency and throughput of each operation.
+#
+#   python benchmarks/storage_bench.py                  SQLite only, in a temporary file
+#   python benchmarks/storage_bench.py --mariadb        SQLite and MariaDB (DB_* settings from .env)
+#
+# The MariaDB run writes real rows, so point it at a scratch database.
+
+SEED_QUOTES = [(f'<bench{n % 50}> benchmark quote number {n} about weather reminders and games', f'bench{n % 50}')
+               for n in range(1000)]
+
+
+async def timed(operation, count, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(n):
+        async with semaphore:
+            started = time.perf_counter()
+            await operation(n)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(n) for n in range(count)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        'p50': statistics.median(latencies) * 1000,
+        'p99': latencies[int(len(latencies) * 0.99) - 1] * 1000,
+        'ops': count / elapsed,
+    }
+
+
+async def run_backend(name, store, count, concurrency):
+    await store.open()
+    await store.seed_quotes(SEED_QUOTES)
+    base = 9_000_000_000_000_000
+    now = datetime.now()
+    operations = [
+        ('set_user_location', lambda n: store.set_user_location(base + n, f'City {n}, Country')),
+        ('set_user_unit', lambda n: store.set_user_unit(base + n, 'F')),
+        ('get_user', lambda n: store.get_user(base + n)),
+        ('add_reminder', lambda n: store.add_reminder(base + n, f'bench reminder {n}', now - timedelta(seconds=n % 60), None, None)),
+        ('claim_reminders', lambda n: claim_and_complete(store, f'bench:{n}')),
+        ('random_quotes', lambda n: store.random_quotes(1)),
+        ('search_quotes', lambda n: store.search_quotes('weather games', 5)),
+    ]
+    print(f'\n{name}: {count} operations each, concurrency {concurrency}')
+    print(f'{"operation":<20}{"p50 ms":>10}{"p99 ms":>10}{"ops/s":>12}')
+    for operation_name, operation in operations:
+        result = await timed(operation, count, concurrency)
+        print(f'{operation_name:<20}{result["p50"]:>10.2f}{result["p99"]:>10.2f}{result["ops"]:>12.0f}')
+    await store.close()
+
+
+async def claim_and_complete(store, claim):
+    for row in await store.claim_reminders(claim, datetime.now(), 60, 10):
+        await store.complete_reminder(row[0], claim)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Benchmark the storage backends.')
+    parser.add_argument('--count', type=int, default=2000, help='operations per benchmark')
+    parser.add_argument('--concurrency', type=int, default=32, help='operations in flight at once')
+    parser.add_argument('--mariadb', action='store_true', help='also benchmark MariaDB')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        await run_backend('sqlite', SQLiteStorage(os.path.join(directory, 'bench.db')), args.count, args.concurrency)
+    if args.mariadb:
+        load_dotenv()
+        await run_backend('mariadb', MariaDBStorage(), args.count, args.concurrency)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -2,7 +2,9 @@ import random
 import os
 import logging
 import discord
+import stats
 from discord import app_commands
+from middleware import player_message
 from discord.ext import tasks, commands
 
 logging.basicConfig(level=logging.DEBUG)
@@ -112,7 +114,7 @@ async def blackjack(interaction):
 
         while player_score < 21:
             await interaction.followup.send('Type `h` to hit or `s` to stand.')
-            msg = await client.wait_for('message')
+            msg = await interaction.client.wait_for('message', check=player_message(interaction))
             if msg.content.lower() == 'h':
                 player_hand.append(game.deal_card())
                 player_score = game.calculate_score(player_hand)
@@ -121,27 +123,34 @@ async def blackjack(interaction):
             else:
                 break
 
+        # A bust loses straight away, the dealer doesn't play.
         if player_score > 21:
             await interaction.followup.send('Bust! You lose.')
-
-        while dealer_score < 17:
-            dealer_hand.append(game.deal_card())
-            dealer_score = game.calculate_score(dealer_hand)
-
-        hand_text = ', '.join([f'{card[1]} of {card[0]}' for card in dealer_hand])
-        await interaction.followup.send(f'Dealer hand: {hand_text}')
-
-        if dealer_score > 21:
-            await interaction.followup.send('Dealer busts! You win!')
-        elif dealer_score > player_score:
-            await interaction.followup.send('Dealer wins!')
-        elif dealer_score < player_score:
-            await interaction.followup.send('You win!')
+            outcome = 'loss'
         else:
-            await interaction.followup.send('Tie!')
+            while dealer_score < 17:
+                dealer_hand.append(game.deal_card())
+                dealer_score = game.calculate_score(dealer_hand)
+
+            hand_text = ', '.join([f'{card[1]} of {card[0]}' for card in dealer_hand])
+            await interaction.followup.send(f'Dealer hand: {hand_text}')
+
+            if dealer_score > 21:
+                await interaction.followup.send('Dealer busts! You win!')
+                outcome = 'win'
+            elif dealer_score > player_score:
+                await interaction.followup.send('Dealer wins!')
+                outcome = 'loss'
+            elif dealer_score < player_score:
+                await interaction.followup.send('You win!')
+                outcome = 'win'
+            else:
+                await interaction.followup.send('Tie!')
+                outcome = 'tie'
+        await stats.record(interaction, 'blackjack', outcome)
 
         await interaction.followup.send('Do you want to play again? Type `y` for yes or `n` for no.')
-        msg = await client.wait_for('message')
+        msg = await interaction.client.wait_for('message', check=player_message(interaction))
         if msg.content.lower() != 'y':
             play_again = False
 
@@ -157,7 +166,7 @@ async def poker(interaction):
         await interaction.response.send_message(f'Your hand: {player_hand[0][1]} of {player_hand[0][0]}, {player_hand[1][1]} of {player_hand[1][0]}, {player_hand[2][1]} of {player_hand[2][0]}, {player_hand[3][1]} of {player_hand[3][0]}, {player_hand[4][1]} of {player_hand[4][0]}')
         await interaction.followup.send('Type the numbers of the cards you want to discard (e.g., `1 3` to discard the first and third cards).')
 
-        msg = await client.wait_for('message')
+        msg = await interaction.client.wait_for('message', check=player_message(interaction))
         discards = [int(i)-1 for i in msg.content.split()]
         for i in sorted(discards, reverse=True):
             player_hand.pop(i)
@@ -174,12 +183,16 @@ async def poker(interaction):
 
         if dealer_score > player_score:
             await interaction.followup.send('Dealer wins!')
+            outcome = 'loss'
         elif dealer_score < player_score:
             await interaction.followup.send('You win!')
+            outcome = 'win'
         else:
             await interaction.followup.send('Tie!')
+            outcome = 'tie'
+        await stats.record(interaction, 'poker', outcome)
 
         await interaction.followup.send('Do you want to play again? Type `y` for yes or `n` for no.')
-        msg = await client.wait_for('message')
+        msg = await interaction.client.wait_for('message', check=player_message(interaction))
         if msg.content.lower() != 'y':
             play_again = False
\ No newline at end of file
@@ -0,0 +1,29 @@
+import aiomysql
+import os
+
+# Shared MariaDB connection pool. Created once on first use and reused by every module,
+# instead of opening a fresh pool for each command.
+
+pool = None
+
+
+async def get_pool():
+    global pool
+    if pool is None:
+        pool = await aiomysql.create_pool(
+            host=os.getenv('DB_HOST'),
+            port=3306,
+            user=os.getenv('DB_USER'),
+            password=os.getenv('DB_PASSWORD'),
+            db=os.getenv('DB_DATABASE'),
+            autocommit=True
+        )
+    return pool
+
+
+async def close_pool():
+    global pool
+    if pool is not None:
+        pool.close()
+        await pool.wait_closed()
+        pool = None
@@ -0,0 +1,124 @@
+import asyncio
+import gzip
+import json
+import os
+import signal
+import time
+
+# Drain mode and warm-state handoff for restarts.
+#
+# While draining, the command tree turns away new interactions (see middleware.py), in-flight
+# interactions get DRAIN_TIMEOUT seconds to finish and pending writes are flushed. Modules then
+# get to dump their warm state (caches, the reminder schedule) into a small gzipped JSON snapshot,
+# which the next process loads at startup so it doesn't start cold.
+#
+# Modules hook in with register_flush(coroutine_function) and register_state(name, dump, load),
+# where dump() returns JSON-serialisable data and load(data) restores it.
+
+DRAIN_TIMEOUT = 20
+SNAPSHOT_MAX_AGE = 300
+# Shard workers each keep their own snapshot.
+shard_suffix = '-' + os.getenv('SHARD_IDS').replace(',', '_') if os.getenv('SHARD_IDS') else ''
+snapshot_path = os.getenv('STATE_SNAPSHOT_PATH', f'data/warm_state{shard_suffix}.json.gz')
+
+draining = False
+active_interactions = set()
+flush_callbacks = []
+state_providers = {}
+
+
+def register_flush(callback):
+    flush_callbacks.append(callback)
+
+
+def register_state(name, dump, load):
+    state_providers[name] = (dump, load)
+
+
+def interaction_started(interaction):
+    active_interactions.add(interaction.id)
+
+
+def interaction_finished(interaction):
+    active_interactions.discard(interaction.id)
+
+# Stop taking new interactions and wait for the running ones to finish. `remaining` is the number
+# of interactions allowed to still be running, so the /restart command doesn't wait for itself.
+
+
+async def drain(remaining=0, timeout=DRAIN_TIMEOUT):
+    global draining
+    draining = True
+    deadline = time.monotonic() + timeout
+    while len(active_interactions) > remaining and time.monotonic() < deadline:
+        await asyncio.sleep(0.1)
+    if len(active_interactions) > remaining:
+        print(f'Drain deadline reached with {len(active_interactions) - remaining} interactions still running')
+    for callback in flush_callbacks:
+        try:
+            await callback()
+        except Exception as e:
+            print(f'Error flushing pending writes: {e}')
+    save_snapshot()
+
+
+def save_snapshot():
+    state = {}
+    for name, (dump, load) in state_providers.items():
+        try:
+            state[name] = dump()
+        except Exception as e:
+            print(f'Error saving {name} state: {e}')
+    os.makedirs(os.path.dirname(snapshot_path) or '.', exist_ok=True)
+    temp_path = snapshot_path + '.tmp'
+    with gzip.open(temp_path, 'wt', encoding='utf-8') as file:
+        json.dump({'saved_at': time.time(), 'state': state}, file, separators=(',', ':'))
+    os.replace(temp_path, snapshot_path)
+    print(f'Saved warm state to {snapshot_path}')
+
+# Shut down cleanly on SIGTERM, which is how `docker stop` and the shard supervisor stop the bot, and
+# on SIGINT. `shutdown` is a coroutine function that drains and closes the bot. Signals are ignored
+# once a shutdown has started, including one started by /shutdown or /restart.
+
+shutdown_tasks = set()
+
+
+def handle_signals(shutdown):
+    loop = asyncio.get_running_loop()
+
+    def handle(signum):
+        if draining or shutdown_tasks:
+            return
+        print(f'Received {signal.Signals(signum).name}, shutting down')
+        task = loop.create_task(shutdown())
+        shutdown_tasks.add(task)
+        task.add_done_callback(shutdown_tasks.discard)
+
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, handle, signum)
+
+# Load the snapshot left by the previous process. It is removed once read so that a later crash
+# never restores stale state, and it is ignored if it is older than SNAPSHOT_MAX_AGE.
+
+
+def load_snapshot():
+    if not os.path.exists(snapshot_path):
+        return
+    try:
+        with gzip.open(snapshot_path, 'rt', encoding='utf-8') as file:
+            snapshot = json.load(file)
+    except (OSError, ValueError) as e:
+        print(f'Unable to read warm state snapshot: {e}')
+        return
+    finally:
+        os.remove(snapshot_path)
+    if time.time() - snapshot['saved_at'] > SNAPSHOT_MAX_AGE:
+        print('Ignoring stale warm state snapshot')
+        return
+    for name, data in snapshot['state'].items():
+        if name in state_providers:
+            try:
+                state_providers[name][1](data)
+            except Exception as e:
+                print(f'Error loading {name} state: {e}')
+    print(f'Loaded warm state from {snapshot_path}')
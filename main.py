@@ -1,20 +1,24 @@
 # Copyright <2023> <Craig J. Wessel>
 
 # Import the required modules.
+import asyncio
 import discord
-import aiomysql
 import logging
 import os
 import sys
-import json
 from weather import weather, setlocation, setunit
 from eightball import eightball
 from flip import flip
-from remind import remind
-from quotes import quote
+from remind import remind, settimezone, reminders, scheduler
+from quotes import quote, quotes, seed_quotes_table, refresh_quote_sample
 from russian_roulette import roulette
 from card_games import blackjack, poker
-from datetime import datetime
+from stats import leaderboard, gamestats, flush_stats
+from storage import get_storage, close_storage
+from middleware import ExodusTree, invocation_counts, deferral_counts
+import lifecycle
+from shards import shard_config
+from reloader import RELOADABLE, reload_module
 from discord import app_commands
 from discord.ext import tasks
 from dotenv import load_dotenv
@@ -27,8 +31,12 @@ discord_logger.setLevel(logging.DEBUG)
 
 intents = discord.Intents.all()
 intents.members = True
-client = discord.Client(intents=intents)
-tree = app_commands.CommandTree(client)
+
+# Sharding. When run under shards.py each worker gets SHARD_COUNT and SHARD_IDS, otherwise
+# discord.py asks the gateway for the recommended shard count and runs all shards here.
+shard_count, shard_ids = shard_config()
+client = discord.AutoShardedClient(intents=intents, shard_count=shard_count, shard_ids=shard_ids)
+tree = ExodusTree(client)
 
 # Register each additional command
 tree.add_command(weather)
@@ -36,120 +44,104 @@ tree.add_command(setlocation)
 tree.add_command(setunit)
 tree.add_command(flip)
 tree.add_command(remind)
+tree.add_command(settimezone)
+tree.add_command(reminders)
 tree.add_command(quote)
+tree.add_command(quotes)
 tree.add_command(roulette)
 tree.add_command(blackjack)
 tree.add_command(poker)
+tree.add_command(leaderboard)
+tree.add_command(gamestats)
 tree.add_command(eightball)
 
-# Connect to the MariaDB database.
-
-
-async def connect_to_db():
-    pool = await aiomysql.create_pool(
-        host=os.getenv('DB_HOST'),
-        port=3306,
-        user=os.getenv('DB_USER'),
-        password=os.getenv('DB_PASSWORD'),
-        db=os.getenv('DB_DATABASE'),
-        autocommit=True
-    )
-    connection = await pool.acquire()
-    return pool, connection
-
-
-# Keep the MariaDB Connection Alive
+# Keep the database connection alive
 @tasks.loop(minutes=5)
-async def keep_alive(pool):
-    async with pool.acquire() as conn:
-        async with conn.cursor() as cur:
-            await cur.execute("SELECT 1")
+async def keep_alive(store):
+    await store.ping()
 
 # Check reminders
 
 
 @tasks.loop(seconds=1)
-async def check_reminders(pool):
-    while True:
-        now = datetime.now()
-        async with pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute("SELECT user_id, reminder, remind_time FROM reminders WHERE remind_time <= %s", (now,))
-                reminders = await cur.fetchall()
-                for row in reminders:
-                    user_id, reminder_message, remind_time = row
-                    user = client.get_user(user_id)
-                    await user.send(f'DO IT: {reminder_message}')
-                    await cur.execute("DELETE FROM reminders WHERE user_id = %s AND reminder = %s AND remind_time = %s", (user_id, reminder_message, remind_time))
-                    await conn.commit()
-
-# Create the users table if it doesn't already exist
-
-
-async def create_users_table(pool):
-    async with pool.acquire() as connection:
-        async with connection.cursor() as cur:
-            await cur.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    id BIGINT PRIMARY KEY,
-                    location VARCHAR(255),
-                    unit CHAR(1)
-                )
-            ''')
+async def check_reminders(store):
+    # Every instance runs this loop. The scheduler leases each upcoming reminder to exactly one
+    # instance, and only the holder of the lease delivers it.
+    await scheduler.tick(store, client)
+
 # Events
 
 
 @client.event
 async def on_ready():
-    pool, connection = await connect_to_db()
-    await create_users_table(pool)
-    keep_alive.start(pool)  # Start the keep-alive task
-    check_reminders.start(pool)  # Start the check reminders task
+    # A shutdown started before the shards were ready has already stopped the tasks and closed storage.
+    if lifecycle.draining:
+        return
+    store = await get_storage()
+    await seed_quotes_table(store)
+    # on_ready fires again after a full reconnect, so only start the tasks once.
+    # The quote sample lives in this process's memory, so every worker refreshes its own.
+    if not keep_alive.is_running():
+        keep_alive.start(store)  # Start the keep-alive task
+    if not refresh_quote_sample.is_running():
+        refresh_quote_sample.start(store)  # Start refreshing the in-memory quote sample
+    # Reminders are claimed with leases, so every worker can share the delivery load.
+    if not check_reminders.is_running():
+        check_reminders.start(store)  # Start the check reminders task
+    if not flush_stats.is_running():
+        flush_stats.start()  # Start writing game stats to the database
     print(f'We have logged in as {client.user}')
 
-# Shutdown cleanup commands
 
+@client.event
+async def on_app_command_completion(interaction, command):
+    lifecycle.interaction_finished(interaction)
 
-async def cleanup_before_shutdown():
-    await save_bot_state()
-    await log_shutdown_event()
-    await close_database_connection()
+# Shutdown cleanup commands
 
 
-async def save_bot_state():
-    # Example: Save user preferences to a JSON file
-    user_preferences = {'user1': {'theme': 'dark', 'language': 'en'}, 'user2': {
-        'theme': 'light', 'language': 'fr'}}
-    with open('user_preferences.json', 'w') as file:
-        json.dump(user_preferences, file)
+async def cleanup_before_shutdown(remaining=1):
+    # Stop claiming reminders and refreshing caches. Reminders already in the schedule are handed to
+    # the next process in the warm state snapshot, so let the current tick finish first.
+    check_reminders.stop()
+    if check_reminders.get_task():
+        await check_reminders.get_task()
+    refresh_quote_sample.cancel()
+    flush_stats.cancel()  # Game stats still pending are written by the drain.
+    keep_alive.cancel()
+    # The shutdown or restart command that called this is still running, so don't wait for it.
+    await lifecycle.drain(remaining=remaining)
+    await log_shutdown_event()
+    await close_storage()
 
 
-async def log_shutdown_event():
-    # Example: Log shutdown event to a file
-    logging.basicConfig(filename='bot_shutdown.log', level=logging.INFO)
-    logging.info('Bot is shutting down.')
+def shards_connected():
+    if client.shard_count is None:
+        return False
+    return len(client.shards) == len(client.shard_ids or range(client.shard_count))
 
 
-async def close_database_connection():
-    pool = None  # Initialize pool outside the try block
+async def shutdown_on_signal():
+    await cleanup_before_shutdown(remaining=0)
+    # Once the client is closed, discord.py keeps retrying any shard it hadn't connected yet, so a
+    # worker stopped while it is still starting up lets its shards finish connecting first. Everything
+    # pending has been written by now.
+    while not shards_connected():
+        await asyncio.sleep(0.5)
+    await client.close()
 
-    try:
-        # Retrieve connection details from environment variables
-        host = os.getenv('DB_HOST')
-        port = 3306
-        user = os.getenv('DB_USER')
-        password = os.getenv('DB_PASSWORD')
-        db = os.getenv('DB_DATABASE')
 
-        # Establish the connection
-        pool = await aiomysql.create_pool(host=host, port=port, user=user, password=password, db=db)
+@client.event
+async def setup_hook():
+    # client.run only handles Ctrl+C, so SIGTERM from `docker stop` or the shard supervisor would
+    # otherwise kill the bot without writing the game stats still pending.
+    lifecycle.handle_signals(shutdown_on_signal)
 
-        # Add code here to perform any necessary database operations before closing
 
-    finally:
-        if pool:
-            pool.close()
-            await pool.wait_closed()
+async def log_shutdown_event():
+    # Example: Log shutdown event to a file
+    logging.basicConfig(filename='bot_shutdown.log', level=logging.INFO)
+    logging.info('Bot is shutting down.')
 
 
 # Commands begin here.
@@ -179,6 +171,19 @@ async def help(interaction):
         embed.add_field(name=cmd.name, value=cmd.description, inline=False)
     await interaction.response.send_message(embed == embed)
 
+# Latency stats. Shows how often each command had to be deferred automatically. ONLY THE OWNER CAN DO THIS!
+
+
+@tree.command(name='latency', description='Show automatic deferral stats. OWNER ONLY!')
+async def latency(interaction):
+    owner_id = os.getenv('OWNER_ID')
+    if str(interaction.user.id) != owner_id:  # Check if the user is the owner.
+        await interaction.response.send_message('You must be the owner to use this command!')
+        return
+    lines = [f'{name}: deferred {deferral_counts[name]} of {count} ({deferral_counts[name] / count:.0%})'
+             for name, count in invocation_counts.most_common()]
+    await interaction.response.send_message('\n'.join(lines) or 'No commands have run yet.')
+
 # Sync Command! ONLY THE OWNER CAN DO THIS!
 
 
@@ -195,6 +200,28 @@ async def sync(interaction: discord.Interaction):
     else:
         await interaction.response.send_message('You must be the owner to use this command!')
 
+# Reload a command module without restarting. ONLY THE OWNER CAN DO THIS!
+
+
+@tree.command(name='reload', description='Reload a command module. OWNER ONLY!')
+@app_commands.choices(module=[app_commands.Choice(name=name, value=name) for name in RELOADABLE])
+async def reload(interaction, module: str):
+    owner_id = os.getenv('OWNER_ID')
+    if str(interaction.user.id) != owner_id:  # Check if the user is the owner.
+        await interaction.response.send_message('You must be the owner to use this command!')
+        return
+    await interaction.response.defer()
+    try:
+        changed = await reload_module(tree, module)
+    except Exception as e:
+        print(f'Error reloading {module}: {e}')
+        await interaction.followup.send(f'Unable to reload {module}: {e}')
+        return
+    if changed:
+        await interaction.followup.send(f'Reloaded {module} and synced changed commands: {", ".join(changed)}.')
+    else:
+        await interaction.followup.send(f'Reloaded {module}.')
+
 # Shutdown command. ONLY THE OWNER CAN DO THIS!
 
 
@@ -228,4 +255,7 @@ async def restart(interaction):
     else:
         await interaction.response.send_message('You do not have permission to reboot the bot.')
 
+# Pick up the warm state left by the previous process, if it restarted recently.
+lifecycle.load_snapshot()
+
 client.run(os.getenv('DISCORD_TOKEN'))
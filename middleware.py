@@ -0,0 +1,97 @@
+import asyncio
+import discord
+from discord import app_commands
+from collections import Counter
+import math
+import lifecycle
+import throttle
+
+# Command tree shared by every command. interaction_check runs before each command and is where
+# interactions get turned away: while the bot is draining for a restart, and when a command's
+# cooldown is used up (see throttle.py). Both are answered straight away without touching the
+# database or any API.
+
+
+# Discord drops an interaction that isn't acknowledged within 3 seconds of being created. Every
+# command that gets past interaction_check is given a DeadlineResponse: if the command hasn't
+# responded DEFER_AFTER seconds after the interaction was created, it is deferred automatically, and
+# any send_message after the interaction has been acknowledged goes out as a followup instead of
+# failing. How often each command needed deferring is counted so slow commands can be found.
+
+DEFER_AFTER = 2.2
+# Commands that only ever answer ephemerally. Once an interaction is deferred, its first followup
+# replaces the "thinking" message and keeps the defer's visibility, so these must be deferred
+# ephemerally too or their replies would be shown to the whole channel.
+ephemeral_commands = {'reminders list', 'reminders cancel'}
+invocation_counts = Counter()
+deferral_counts = Counter()
+# Holds on to the deferral timers so they aren't garbage collected while they wait.
+deferral_tasks = set()
+
+
+class DeadlineResponse(discord.InteractionResponse):
+    def __init__(self, parent):
+        super().__init__(parent)
+        # Stops the automatic defer and the command's own response from racing each other.
+        self.lock = asyncio.Lock()
+
+    async def defer(self, **kwargs):
+        async with self.lock:
+            if not self.is_done():
+                await super().defer(**kwargs)
+
+    async def send_message(self, *args, **kwargs):
+        async with self.lock:
+            if not self.is_done():
+                return await super().send_message(*args, **kwargs)
+        return await self._parent.followup.send(*args, **kwargs)
+
+    async def defer_before_deadline(self, command_name):
+        elapsed = (discord.utils.utcnow() - self._parent.created_at).total_seconds()
+        await asyncio.sleep(max(0, DEFER_AFTER - elapsed))
+        async with self.lock:
+            if self.is_done():
+                return
+            try:
+                await super().defer(ephemeral=command_name in ephemeral_commands)
+            except discord.HTTPException as e:
+                print(f'Unable to defer {command_name}: {e}')
+                return
+        deferral_counts[command_name] += 1
+        print(f'Deferred {command_name} automatically')
+
+
+# Games take the player's moves with interaction.client.wait_for(), waiting on the client that
+# received the interaction rather than on module state, so a game in progress keeps working if its
+# module is hot reloaded. This check lives here because this module is never reloaded. Only the
+# player's own messages in the game's channel count as moves.
+
+def player_message(interaction):
+    return lambda msg: msg.author.id == interaction.user.id and msg.channel.id == interaction.channel_id
+
+
+class ExodusTree(app_commands.CommandTree):
+    async def interaction_check(self, interaction):
+        if lifecycle.draining:
+            await interaction.response.send_message('The bot is restarting, please try again in a few seconds.', ephemeral=True)
+            return False
+        retry_after = throttle.check(interaction)
+        if retry_after:
+            await interaction.response.send_message(f'Slow down! Try that again in {math.ceil(retry_after)} seconds.', ephemeral=True)
+            return False
+        lifecycle.interaction_started(interaction)
+        if interaction.command:
+            command_name = interaction.command.qualified_name
+            invocation_counts[command_name] += 1
+            interaction._cs_response = DeadlineResponse(interaction)
+            task = asyncio.create_task(interaction._cs_response.defer_before_deadline(command_name))
+            deferral_tasks.add(task)
+            task.add_done_callback(deferral_tasks.discard)
+        return True
+
+    async def on_error(self, interaction, error):
+        lifecycle.interaction_finished(interaction)
+        # Interactions turned away by interaction_check have already been answered.
+        if isinstance(error, app_commands.CheckFailure):
+            return
+        await super().on_error(interaction, error)
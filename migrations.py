@@ -0,0 +1,202 @@
+from contextlib import asynccontextmanager
+
+# Versioned schema migrations. Each migration runs once, in order, and its version is recorded in
+# schema_migrations. Statements use IF NOT EXISTS so they also apply cleanly to databases that were
+# created before migrations existed. Add new migrations to the end of the list, never edit old ones.
+
+migrations = [
+    (1, 'Create the users, reminders and quotes tables', [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            id BIGINT PRIMARY KEY,
+            location VARCHAR(255),
+            unit CHAR(1)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS reminders (
+            user_id BIGINT,
+            reminder TEXT,
+            remind_time DATETIME
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS quotes (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            quote TEXT NOT NULL,
+            author VARCHAR(255),
+            added_by BIGINT,
+            added_at DATETIME,
+            INDEX idx_quotes_author (author),
+            FULLTEXT INDEX idx_quotes_quote (quote)
+        )
+        ''',
+    ]),
+    (2, 'Add user time zones and reminder leases and schedules', [
+        'ALTER TABLE users ADD COLUMN IF NOT EXISTS timezone VARCHAR(64)',
+        '''
+        ALTER TABLE reminders
+            ADD COLUMN IF NOT EXISTS claimed_by VARCHAR(64),
+            ADD COLUMN IF NOT EXISTS claim_expires DATETIME,
+            ADD COLUMN IF NOT EXISTS recurrence VARCHAR(64),
+            ADD COLUMN IF NOT EXISTS timezone VARCHAR(64)
+        ''',
+    ]),
+    (3, 'Add a primary key and indexes to reminders', [
+        'ALTER TABLE reminders ADD COLUMN IF NOT EXISTS id BIGINT AUTO_INCREMENT PRIMARY KEY FIRST',
+        'CREATE INDEX IF NOT EXISTS idx_reminders_remind_time ON reminders (remind_time)',
+        'CREATE INDEX IF NOT EXISTS idx_reminders_user_id ON reminders (user_id)',
+        'CREATE INDEX IF NOT EXISTS idx_reminders_claimed_by ON reminders (claimed_by)',
+    ]),
+    (4, 'Create the game_stats table', [
+        '''
+        CREATE TABLE IF NOT EXISTS game_stats (
+            guild_id BIGINT NOT NULL,
+            user_id BIGINT NOT NULL,
+            game VARCHAR(32) NOT NULL,
+            wins INT NOT NULL DEFAULT 0,
+            losses INT NOT NULL DEFAULT 0,
+            ties INT NOT NULL DEFAULT 0,
+            streak INT NOT NULL DEFAULT 0,
+            best_streak INT NOT NULL DEFAULT 0,
+            updated_at DATETIME,
+            PRIMARY KEY (guild_id, user_id, game),
+            INDEX idx_game_stats_wins (guild_id, game, wins)
+        )
+        ''',
+    ]),
+    (5, 'Index reminders by user and time for listing', [
+        'CREATE INDEX IF NOT EXISTS idx_reminders_user_time ON reminders (user_id, remind_time, id)',
+        'DROP INDEX IF EXISTS idx_reminders_user_id ON reminders',
+    ]),
+]
+
+# Apply any migrations that haven't been applied yet. Several bot instances may start at the same
+# time, so the whole run holds a named lock. Other startup work that must only happen once, like
+# seeding the quotes table, takes the same lock.
+
+MIGRATION_LOCK = 'exodus2_migrations'
+MIGRATION_LOCK_TIMEOUT = 60
+
+
+@asynccontextmanager
+async def migration_lock(cur):
+    # GET_LOCK returns 0 when another instance held the lock for the whole timeout and NULL on
+    # error. Going ahead without the lock could apply the same change twice, so give up instead.
+    await cur.execute('SELECT GET_LOCK(%s, %s)', (MIGRATION_LOCK, MIGRATION_LOCK_TIMEOUT))
+    (locked,) = await cur.fetchone()
+    if locked != 1:
+        raise RuntimeError('Could not get the migration lock, another instance may still be migrating')
+    try:
+        yield
+    finally:
+        await cur.execute('SELECT RELEASE_LOCK(%s)', (MIGRATION_LOCK,))
+
+
+async def run_migrations(pool):
+    async with pool.acquire() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute('''
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INT PRIMARY KEY,
+                    description VARCHAR(255),
+                    applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            async with migration_lock(cur):
+                await cur.execute('SELECT version FROM schema_migrations')
+                applied = {row[0] for row in await cur.fetchall()}
+                for version, description, statements in migrations:
+                    if version in applied:
+                        continue
+                    print(f'Applying migration {version}: {description}')
+                    for statement in statements:
+                        await cur.execute(statement)
+                    await cur.execute('INSERT INTO schema_migrations (version, description) VALUES (%s, %s)',
+                                      (version, description))
+
+# The same schema for the embedded SQLite backend. SQLite keeps the applied version in
+# PRAGMA user_version instead of a table. Keep these in step with the MariaDB migrations above.
+
+sqlite_migrations = [
+    (1, 'Create the users, reminders and quotes tables', [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY,
+            location TEXT,
+            unit TEXT,
+            timezone TEXT
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS reminders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            reminder TEXT,
+            remind_time TEXT,
+            claimed_by TEXT,
+            claim_expires TEXT,
+            recurrence TEXT,
+            timezone TEXT
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_reminders_remind_time ON reminders (remind_time)',
+        'CREATE INDEX IF NOT EXISTS idx_reminders_user_id ON reminders (user_id)',
+        'CREATE INDEX IF NOT EXISTS idx_reminders_claimed_by ON reminders (claimed_by)',
+        '''
+        CREATE TABLE IF NOT EXISTS quotes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            quote TEXT NOT NULL,
+            author TEXT,
+            added_by INTEGER,
+            added_at TEXT
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_quotes_author ON quotes (author)',
+        "CREATE VIRTUAL TABLE IF NOT EXISTS quotes_fts USING fts5(quote, content='quotes', content_rowid='id')",
+        '''
+        CREATE TRIGGER IF NOT EXISTS quotes_fts_insert AFTER INSERT ON quotes BEGIN
+            INSERT INTO quotes_fts (rowid, quote) VALUES (new.id, new.quote);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS quotes_fts_delete AFTER DELETE ON quotes BEGIN
+            INSERT INTO quotes_fts (quotes_fts, rowid, quote) VALUES ('delete', old.id, old.quote);
+        END
+        ''',
+    ]),
+    (2, 'Create the game_stats table', [
+        '''
+        CREATE TABLE IF NOT EXISTS game_stats (
+            guild_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            game TEXT NOT NULL,
+            wins INTEGER NOT NULL DEFAULT 0,
+            losses INTEGER NOT NULL DEFAULT 0,
+            ties INTEGER NOT NULL DEFAULT 0,
+            streak INTEGER NOT NULL DEFAULT 0,
+            best_streak INTEGER NOT NULL DEFAULT 0,
+            updated_at TEXT,
+            PRIMARY KEY (guild_id, user_id, game)
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_game_stats_wins ON game_stats (guild_id, game, wins)',
+    ]),
+    (3, 'Index reminders by user and time for listing', [
+        'CREATE INDEX IF NOT EXISTS idx_reminders_user_time ON reminders (user_id, remind_time, id)',
+        'DROP INDEX IF EXISTS idx_reminders_user_id',
+    ]),
+]
+
+
+def run_sqlite_migrations(conn):
+    applied = conn.execute('PRAGMA user_version').fetchone()[0]
+    for version, description, statements in sqlite_migrations:
+        if version <= applied:
+            continue
+        print(f'Applying SQLite migration {version}: {description}')
+        conn.execute('BEGIN')
+        for statement in statements:
+            conn.execute(statement)
+        conn.execute(f'PRAGMA user_version = {version}')
+        conn.execute('COMMIT')
@@ -2,9 +2,13 @@ import discord
 import random 
 import logging
 import os
+import re
 import sys
+from datetime import datetime
 from discord import app_commands
 from discord.ext import commands, tasks
+import lifecycle
+from storage import get_storage
 
 logging.basicConfig(level=logging.DEBUG)
 discord_logger = logging.getLogger('discord')
@@ -15,36 +19,119 @@ intents.members = True
 client = discord.Client(intents=intents)
 tree = app_commands.CommandTree(client)
 
-# Quotes for the Quote Command
+# Quotes from the old IRC days. These seed the quotes table the first time it is created.
+# Multi-line quotes keep one IRC line per line.
 
-quotes=[
+seed_quotes=[
     "<Leo7Mario> I want to make an IRC Bot, is there a way to make one in HTML?",
     "<`> Gerbils",
     "<|> Morse code is the best encryption algorhythm ever.",
     "<erno> Hmmm. I've lost a machine. Literally LOST. It responds to ping, it works completely, I just can't figure out where in my apartment it is.",
     "<Ubre> I'M RETARDED!",
     "<KK> Immo go rape my eyes.",
-    "<KomputerKid> Hey did you know if you type your password in it shows up as stars! *********** See? "
-    "<JacobGuy7800> mariospro "
+    "<KomputerKid> Hey did you know if you type your password in it shows up as stars! *********** See?\n"
+    "<JacobGuy7800> mariospro\n"
     "<JacobGuy7800> Wait, DAMMIT",
     "<billy_mccletus> The onlee wuhn whose gunna be marryin' mah sister is gunna be me.",
     "<maxell> He just needs to realize we're one giant schizophrenic cat floating in a void...",
     "<KomputerKid> Why are you gae?",
     "<|> The holy bobble says 'Fuck you'",
-    "<psychobat> https://www.youtube.com/watch?v=HqF_nPbX_Ow "
-    "<Amity> Amity has quit. (Shutting down...) "
+    "<psychobat> https://www.youtube.com/watch?v=HqF_nPbX_Ow\n"
+    "<Amity> Amity has quit. (Shutting down...)\n"
     "<lily> Amity did not expect the spanish inquisition.",
-    "<psychobat> ?quote "
-    "<psychobat> https://www.youtube.com/watch?v=HqF_nPbX_Ow "
-    "<Amity> Amity has quit. (Shutting down...) "
-    "<lily> Amity did not expect the spanish inquisition. "
-    "<Leo7Mario> Leo7Mario has quit. (Shutting down...) "
+    "<psychobat> ?quote\n"
+    "<psychobat> https://www.youtube.com/watch?v=HqF_nPbX_Ow\n"
+    "<Amity> Amity has quit. (Shutting down...)\n"
+    "<lily> Amity did not expect the spanish inquisition.\n"
+    "<Leo7Mario> Leo7Mario has quit. (Shutting down...)\n"
     "<psychobat> Nor did Leo7Mario.",
 ]
 
-# Quote command. Pulls from quotes above.
+# The plain /quote command only ever reads from this in-memory sample. It starts out as the
+# seed quotes and is refreshed from the database in the background.
+
+SAMPLE_SIZE = 500
+quote_sample = list(seed_quotes)
+
+# Keep the sample when this module is hot reloaded.
+reload_keep = ('quote_sample',)
+
+
+def dump_quote_sample():
+    return quote_sample
+
+
+def load_quote_sample(sample):
+    quote_sample[:] = sample
+
+
+lifecycle.register_state('quotes', dump_quote_sample, load_quote_sample)
+
+author_pattern = re.compile(r'^<([^>]+)>')
+
+
+def quote_author(text):
+    match = author_pattern.match(text)
+    return match.group(1) if match else None
+
+# Seed the quotes table with the old IRC quotes if it is empty.
+
+
+async def seed_quotes_table(store):
+    await store.seed_quotes([(text, quote_author(text)) for text in seed_quotes])
+
+
+@tasks.loop(minutes=10)
+async def refresh_quote_sample(store):
+    try:
+        sample = await store.random_quotes(SAMPLE_SIZE)
+    except Exception as e:
+        print(f"Error refreshing quote sample: {e}")
+        return
+    if sample:
+        quote_sample[:] = sample
+
+
+def format_quotes(rows):
+    text = '\n\n'.join(f'#{quote_id}\n{quote}' for quote_id, quote in rows)
+    return text if len(text) <= 2000 else text[:1997] + '...'
+
+# Quote command. Pulls from the in-memory sample above and never touches the database.
 
 @tree.command(name='quote', description='Get a random quote from the old IRC Days')
 async def quote(interaction):
-    random_quote = random.choice(quotes)
-    await interaction.response.send_message(random_quote)
\ No newline at end of file
+    random_quote = random.choice(quote_sample)
+    await interaction.response.send_message(random_quote)
+
+# Quote database commands.
+
+quotes = app_commands.Group(name='quotes', description='Add and search quotes')
+
+
+@quotes.command(name='add', description='Add a quote')
+async def quotes_add(interaction, text: str, author: str = None):
+    author = author or quote_author(text)
+    store = await get_storage()
+    quote_id = await store.add_quote(text, author, interaction.user.id)
+    quote_sample.append(text)
+    await interaction.response.send_message(f'Quote #{quote_id} added!')
+
+
+@quotes.command(name='search', description='Search the quotes')
+async def quotes_search(interaction, text: str):
+    store = await get_storage()
+    rows = await store.search_quotes(text, 5)
+    if not rows:
+        await interaction.response.send_message(f'No quotes found matching "{text}".')
+        return
+    await interaction.response.send_message(format_quotes(rows))
+
+
+@quotes.command(name='author', description='Show quotes by an author')
+async def quotes_author(interaction, author: str):
+    store = await get_storage()
+    rows = await store.quotes_by_author(author, 5)
+    if not rows:
+        await interaction.response.send_message(f'No quotes found by {author}.')
+        return
+    await interaction.response.send_message(format_quotes(rows))
\ No newline at end of file
@@ -0,0 +1,51 @@
+import importlib
+import sys
+from discord import app_commands
+
+# Hot reload of command modules. importlib.reload re-runs a module's code in its existing namespace,
+# so anything the module lists in `reload_keep` (caches, schedules) is saved first and put back
+# afterwards. The database connection lives in storage.py, which is never reloaded. Coroutines that
+# are already running, such as a game in progress, keep running the code they started with.
+
+RELOADABLE = ('weather', 'card_games', 'russian_roulette', 'eightball', 'flip', 'quotes', 'remind')
+
+
+def module_commands(module):
+    return {value.name: value for value in vars(module).values()
+            if isinstance(value, (app_commands.Command, app_commands.Group)) and value.parent is None}
+
+
+def command_signature(command):
+    if isinstance(command, app_commands.Group):
+        return (command.name, command.description, tuple(command_signature(sub) for sub in command.commands))
+    return (command.name, command.description,
+            tuple((param.name, param.description, param.type, param.required,
+                   tuple(choice.value for choice in param.choices)) for param in command.parameters))
+
+# Reload a command module and swap its commands on the tree. Discord only needs to hear about it
+# when a command was added, removed or changed its signature, so the tree is only synced then.
+# Returns the names of the commands that changed.
+
+
+async def reload_module(tree, name):
+    module = sys.modules[name]
+    old_commands = module_commands(module)
+    kept = {attr: getattr(module, attr) for attr in getattr(module, 'reload_keep', ())}
+    try:
+        importlib.reload(module)
+    finally:
+        for attr, value in kept.items():
+            setattr(module, attr, value)
+    new_commands = module_commands(module)
+
+    for command_name in old_commands:
+        tree.remove_command(command_name)
+    for command in new_commands.values():
+        tree.add_command(command, override=True)
+
+    changed = sorted(command_name for command_name in old_commands.keys() | new_commands.keys()
+                     if command_name not in old_commands or command_name not in new_commands
+                     or command_signature(old_commands[command_name]) != command_signature(new_commands[command_name]))
+    if changed:
+        await tree.sync()
+    return changed
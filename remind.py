@@ -1,14 +1,19 @@
 import discord
 from discord import app_commands
 from discord.ext import tasks
-from datetime import datetime, timedelta
-import aiomysql
+from datetime import datetime, timedelta, date, time
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 import logging
 import re
 import asyncio
 import os
 import sys
 import json
+import socket
+import itertools
+import heapq
+import lifecycle
+from storage import get_storage
 
 logging.basicConfig(level=logging.DEBUG)
 discord_logger = logging.getLogger('discord')
@@ -19,65 +24,371 @@ intents.members = True
 client = discord.Client(intents=intents)
 tree = app_commands.CommandTree(client)
 
-async def connect_to_db():
-    pool = await aiomysql.create_pool(
-        host=os.getenv('DB_HOST'),
-        port=3306,
-        user=os.getenv('DB_USER'),
-        password=os.getenv('DB_PASSWORD'),
-        db=os.getenv('DB_DATABASE'),
-        autocommit=True
-    )
-    connection = await pool.acquire()
-    return pool, connection
+# Reminder leases. A bot instance claims upcoming reminders by stamping them with a claim id and
+# a lease expiry in a single UPDATE, so two instances never deliver the same reminder. If an
+# instance dies before delivering, its leases expire and another instance picks the reminders up.
+# Every claim gets its own id, so a reminder that failed to send is not picked up again by the
+# same instance until its lease has expired.
 
+LEASE_SECONDS = 60
+CLAIM_BATCH = 100
+RETRY_SECONDS = 60
+instance_id = f'{socket.gethostname()}:{os.getpid()}'
+claim_counter = itertools.count()
+
+async def get_user_timezone(user_id, store):
+    user = await store.get_user(user_id)
+    return load_timezone(user[2]) if user else None
+
+
+def load_timezone(name):
+    try:
+        return ZoneInfo(name) if name else None
+    except (ZoneInfoNotFoundError, ValueError):
+        return None
+
+# Reminder scheduler. Only the reminders due within the next HORIZON_SECONDS are claimed and kept
+# in memory, in a heap ordered by fire time. Claiming is an indexed range query on remind_time and
+# firing pops the heap, so neither step looks at reminders that are not about to fire, however
+# many recurring reminders are stored.
+
+HORIZON_SECONDS = 30
+CLAIM_INTERVAL = 10
+
+
+class ReminderScheduler:
+    def __init__(self):
+        self.heap = []
+        self.sequence = itertools.count()
+        self.next_claim = datetime.min
+
+    def push(self, row):
+        heapq.heappush(self.heap, (row[3], next(self.sequence), row))
+
+    def cancel(self, reminder_id):
+        # The heap only holds the next HORIZON_SECONDS of reminders, so rebuilding it is cheap.
+        self.heap = [entry for entry in self.heap if entry[2][0] != reminder_id]
+        heapq.heapify(self.heap)
+
+    async def tick(self, store, client):
+        now = datetime.now()
+        if now >= self.next_claim:
+            # The lease runs until LEASE_SECONDS after each reminder is due, so it is held while the
+            # reminder waits in the heap.
+            claim = f'{instance_id}:{next(claim_counter)}'
+            # A database error must not escape, tasks.loop would stop and this instance would never
+            # deliver another reminder. Try again at the next claim interval.
+            try:
+                rows = await store.claim_reminders(claim, now + timedelta(seconds=HORIZON_SECONDS), LEASE_SECONDS, CLAIM_BATCH)
+            except Exception as e:
+                print(f"Error claiming reminders: {e}")
+                rows = []
+            for row in rows:
+                self.push(row)
+            # Claim again straight away if the batch was full.
+            self.next_claim = now if len(rows) == CLAIM_BATCH else now + timedelta(seconds=CLAIM_INTERVAL)
+        while self.heap and self.heap[0][0] <= now:
+            row = heapq.heappop(self.heap)[2]
+            try:
+                await self.fire(store, client, row)
+            except Exception as e:
+                # The lease is left to lapse, so the reminder is claimed and tried again.
+                print(f"Error firing reminder {row[0]}: {e}")
+
+    async def fire(self, store, client, row):
+        reminder_id, user_id, reminder_message, remind_time, recurrence, timezone, claim = row
+        # Take the reminder before sending it by moving it RETRY_SECONDS out, under our claim. If it
+        # was cancelled in the meantime, possibly through another instance, there is nothing left to
+        # take and it isn't sent. It is only completed once it has been sent, so if this instance
+        # dies before then, the reminder is claimed again and retried when its lease runs out.
+        if not await store.take_reminder(reminder_id, claim, datetime.now() + timedelta(seconds=RETRY_SECONDS)):
+            return
+        try:
+            user = client.get_user(user_id) or await client.fetch_user(user_id)
+            await user.send(f'DO IT: {reminder_message}')
+        except (discord.Forbidden, discord.NotFound) as e:
+            # The user can't be reached, so drop the reminder instead of retrying it forever.
+            print(f"Unable to deliver reminder to {user_id}: {e}")
+            await store.complete_reminder(reminder_id, claim)
+            return
+        except Exception as e:
+            # Leave the reminder where it was taken to, it is retried once the lease runs out.
+            print(f"Error delivering reminder to {user_id}: {e}")
+            return
+        if recurrence:
+            next_time = next_fire_time(recurrence, remind_time, load_timezone(timezone))
+            await store.reschedule_reminder(reminder_id, claim, next_time)
+        else:
+            await store.complete_reminder(reminder_id, claim)
+
+    # The schedule is handed to the next process on restart. Reminders are only taken back while
+    # this instance's lease on them is still comfortably valid.
+
+    def dump(self):
+        return [[reminder_id, user_id, message, remind_time.isoformat(), recurrence, timezone, claim]
+                for _, _, (reminder_id, user_id, message, remind_time, recurrence, timezone, claim) in self.heap]
+
+    def load(self, rows):
+        cutoff = datetime.now() - timedelta(seconds=LEASE_SECONDS / 2)
+        for reminder_id, user_id, message, remind_time, recurrence, timezone, claim in rows:
+            remind_time = datetime.fromisoformat(remind_time)
+            if remind_time > cutoff:
+                self.push((reminder_id, user_id, message, remind_time, recurrence, timezone, claim))
+
+
+scheduler = ReminderScheduler()
+
+# Keep the schedule and claim ids when this module is hot reloaded.
+reload_keep = ('scheduler', 'claim_counter')
+
+
+def dump_schedule():
+    return scheduler.dump()
+
+
+def load_schedule(rows):
+    scheduler.load(rows)
+
+
+lifecycle.register_state('reminders', dump_schedule, load_schedule)
 
 # Remind me command!
 
 @tree.command(name='remind', description='Set a Reminder!')
 async def remind(interaction, reminder_time: str, *, reminder: str):
-    remind_time = parse_reminder_time(reminder_time)
-    # Use create_pool directly here
-    async with aiomysql.create_pool(
-        host=os.getenv('DB_HOST'),
-        port=3306,
-        user=os.getenv('DB_USER'),
-        password=os.getenv('DB_PASSWORD'),
-        db=os.getenv('DB_DATABASE'),
-        autocommit=True
-    ) as pool:
-        async with pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                sql = "INSERT INTO reminders (user_id, reminder, remind_time) VALUES (%s, %s, %s)"
-                val = (interaction.user.id, reminder, remind_time)
-                await cur.execute(sql, val)
-        await interaction.response.send_message(f'Reminder set! I will remind you at {remind_time}.')
-
-def parse_reminder_time(reminder_time: str) -> datetime:
-    # Implement your parsing logic here
-    # Example: '2h30m' means 2 hours and 30 minutes
-    # You need to convert this string into a timedelta object
-    # You may use regular expressions to extract the time components
-
-    # For simplicity, let's assume the input is in the format 'XhYmZs'
-    hours, minutes, seconds = 0, 0, 0
-
-    # Parse hours
-    if 'h' in reminder_time:
-        hours_str, reminder_time = reminder_time.split('h', 1)
-        hours = int(hours_str)
-
-    # Parse minutes
-    if 'm' in reminder_time:
-        minutes_str, reminder_time = reminder_time.split('m', 1)
-        minutes = int(minutes_str)
-
-    # Parse seconds
-    if 's' in reminder_time:
-        seconds_str, reminder_time = reminder_time.split('s', 1)
-        seconds = int(seconds_str)
-
-    # Calculate the total timedelta
-    delta = timedelta(hours=hours, minutes=minutes, seconds=seconds)
-
-    return datetime.now() + delta
\ No newline at end of file
+    store = await get_storage()
+    tz = await get_user_timezone(interaction.user.id, store)
+    try:
+        remind_time, recurrence = parse_reminder_time(reminder_time, tz)
+    except ValueError as e:
+        await interaction.response.send_message(f'{e} Try something like `2h30m`, `3 days`, `tomorrow 9:00`, `friday 6pm` or `every weekday 9:00`.')
+        return
+    await store.add_reminder(interaction.user.id, reminder, remind_time, recurrence, tz.key if tz else None)
+    if recurrence:
+        await interaction.response.send_message(f'Recurring reminder set! I will first remind you <t:{int(remind_time.timestamp())}:F>.')
+    else:
+        await interaction.response.send_message(f'Reminder set! I will remind you <t:{int(remind_time.timestamp())}:F>.')
+
+# Set your time zone. Absolute and recurring reminders are read in this time zone.
+
+@tree.command(name='settimezone', description='Set your time zone for reminders')
+async def settimezone(interaction, timezone: str):
+    if load_timezone(timezone) is None:
+        await interaction.response.send_message('Unknown time zone. Please use a name like `America/New_York` or `Europe/London`.')
+        return
+    store = await get_storage()
+    await store.set_user_timezone(interaction.user.id, timezone)
+    await interaction.response.send_message(f'Your time zone has been set to {timezone}.')
+
+# Reminder list and cancel commands. Lists are paged with a cursor, the time and id of the last
+# reminder shown, so every page is a range scan on the (user_id, remind_time, id) index instead of
+# an OFFSET that reads and throws away all the earlier pages.
+
+PAGE_SIZE = 10
+
+reminders = app_commands.Group(name='reminders', description='List and cancel your reminders')
+
+
+def page_cursor(row):
+    reminder_id, reminder, remind_time, recurrence = row
+    return f'{int(remind_time.timestamp())}-{reminder_id}'
+
+
+def parse_cursor(cursor):
+    try:
+        timestamp, reminder_id = cursor.split('-')
+        return datetime.fromtimestamp(int(timestamp)), int(reminder_id)
+    except ValueError:
+        return None
+
+
+@reminders.command(name='list', description='List your reminders')
+async def reminders_list(interaction, after: str = None):
+    position = None
+    if after is not None:
+        position = parse_cursor(after)
+        if position is None:
+            await interaction.response.send_message('That is not a valid page. Use the `after` value from the end of a list.', ephemeral=True)
+            return
+    store = await get_storage()
+    rows = await store.list_reminders(interaction.user.id, position, PAGE_SIZE + 1)
+    if not rows:
+        await interaction.response.send_message('You have no reminders.' if after is None else 'There are no more reminders.', ephemeral=True)
+        return
+    lines = []
+    for reminder_id, reminder, remind_time, recurrence in rows[:PAGE_SIZE]:
+        text = reminder if len(reminder) <= 100 else reminder[:97] + '...'
+        repeat = ' (recurring)' if recurrence else ''
+        lines.append(f'#{reminder_id} <t:{int(remind_time.timestamp())}:F>{repeat}: {text}')
+    if len(rows) > PAGE_SIZE:
+        lines.append(f'More: `/reminders list after:{page_cursor(rows[PAGE_SIZE - 1])}`')
+    await interaction.response.send_message('\n'.join(lines), ephemeral=True)
+
+
+@reminders.command(name='cancel', description='Cancel one of your reminders')
+async def reminders_cancel(interaction, reminder_id: int):
+    store = await get_storage()
+    if not await store.cancel_reminder(interaction.user.id, reminder_id):
+        await interaction.response.send_message(f'You have no reminder #{reminder_id}.', ephemeral=True)
+        return
+    scheduler.cancel(reminder_id)
+    await interaction.response.send_message(f'Reminder #{reminder_id} cancelled.', ephemeral=True)
+
+# Reminder time grammar. Everything is matched case-insensitively against precompiled patterns:
+#
+#   2h30m, 90 minutes, 1w 2d       relative to now
+#   9:00, 6pm, tomorrow 9:00       the next time the clock shows that time
+#   friday 18:30, 2024-12-25 8am   a day (the next one with that name) and a time
+#   every weekday 9:00             every Monday to Friday
+#   every mon,wed,fri 7am          the listed days
+#   every day 21:00, every weekend 10:00
+#   every 2h, every week           a fixed interval
+#
+# Stored times are naive server-local datetimes, like the rest of the reminders table. Recurring
+# reminders are stored as 'interval:<seconds>' or 'weekly:<days>@<HH:MM>', where days are
+# weekday numbers (Monday is 0), and are read in the user's time zone.
+
+unit_seconds = {'w': 604800, 'd': 86400, 'h': 3600, 'm': 60, 's': 1}
+day_names = ('monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday')
+day_sets = {'day': '0123456', 'weekday': '01234', 'weekend': '56'}
+
+unit = r'(?:weeks?|wks?|w|days?|d|hours?|hrs?|h|minutes?|mins?|m|seconds?|secs?|s)'
+day_name = r'(?:mon|tue|wed|thu|fri|sat|sun)[a-z]*'
+clock = r'(?:at\s+)?(?P<hour>\d{1,2})(?::(?P<minute>\d{2}))?\s*(?P<ampm>am|pm)?'
+
+duration_part_pattern = re.compile(rf'(\d+)\s*({unit})')
+duration_pattern = re.compile(rf'(?:in\s+)?(?:\d+\s*{unit}\s*(?:,|and)?\s*)+')
+absolute_pattern = re.compile(rf'(?:on\s+)?(?:(?P<day>\d{{4}}-\d{{2}}-\d{{2}}|today|tomorrow|{day_name})\s+)?{clock}')
+weekly_pattern = re.compile(rf'every\s+(?P<days>day|weekday|weekend|{day_name}(?:\s*(?:,|and)\s*{day_name})*)\s+{clock}')
+interval_pattern = re.compile(rf'every\s+(?P<interval>(?:\d+\s*{unit}\s*(?:,|and)?\s*)+|{unit})')
+day_split_pattern = re.compile(r'\s*(?:,|and)\s*')
+
+MIN_INTERVAL = 60
+
+
+def duration_seconds(text):
+    parts = duration_part_pattern.findall(text)
+    if not parts:
+        # A bare unit such as 'every hour'.
+        return unit_seconds[text[0]]
+    return sum(int(amount) * unit_seconds[name[0]] for amount, name in parts)
+
+
+def parse_clock(match):
+    hour = int(match.group('hour'))
+    minute = int(match.group('minute') or 0)
+    ampm = match.group('ampm')
+    if match.group('minute') is None and ampm is None:
+        raise ValueError(f"I couldn't tell whether {hour} is a time.")
+    if ampm:
+        if not 1 <= hour <= 12:
+            raise ValueError(f'{hour}{ampm} is not a valid time.')
+        hour = hour % 12 + (12 if ampm == 'pm' else 0)
+    if hour > 23 or minute > 59:
+        raise ValueError(f'{hour}:{minute:02d} is not a valid time.')
+    return time(hour, minute)
+
+
+def parse_day_name(name):
+    for index, full_name in enumerate(day_names):
+        if full_name.startswith(name) or name in (full_name[:3] + 's', full_name + 's'):
+            return index
+    raise ValueError(f'{name} is not a day of the week.')
+
+# Naive datetimes are server-local. Aware datetimes (in the user's time zone) are converted to
+# naive server-local time before being stored.
+
+
+def to_server_time(when):
+    return when.astimezone().replace(tzinfo=None) if when.tzinfo else when
+
+
+def from_server_time(when, tz):
+    return when.astimezone(tz) if tz else when
+
+
+def next_fire_time(recurrence, after, tz=None):
+    # Missed occurrences (for example while the bot was down) are skipped, not replayed. Intervals
+    # step from the previous fire time by whole intervals, so they don't drift later by however long
+    # each delivery took.
+    now = datetime.now()
+    kind, _, spec = recurrence.partition(':')
+    if kind == 'interval':
+        interval = timedelta(seconds=int(spec))
+        steps = (now - after) // interval + 1 if after <= now else 1
+        return after + steps * interval
+    after = max(after, now)
+    days, _, at = spec.partition('@')
+    at = time.fromisoformat(at)
+    local_after = from_server_time(after, tz)
+    for offset in range(8):
+        day = local_after.date() + timedelta(days=offset)
+        if str(day.weekday()) not in days:
+            continue
+        candidate = datetime.combine(day, at, tzinfo=tz)
+        if candidate > local_after:
+            return to_server_time(candidate)
+    raise ValueError(f'Invalid recurrence {recurrence}.')
+
+
+def parse_absolute_time(match, tz):
+    now = datetime.now(tz)
+    at = parse_clock(match)
+    day = match.group('day')
+    if day is None or day in ('today', 'tomorrow'):
+        when = datetime.combine(now.date(), at, tzinfo=tz)
+        if day == 'tomorrow' or (day is None and when <= now):
+            when = datetime.combine(now.date() + timedelta(days=1), at, tzinfo=tz)
+    elif day[0].isdigit():
+        when = datetime.combine(date.fromisoformat(day), at, tzinfo=tz)
+    else:
+        days_ahead = (parse_day_name(day) - now.weekday()) % 7
+        when = datetime.combine(now.date() + timedelta(days=days_ahead), at, tzinfo=tz)
+        if when <= now:
+            when = datetime.combine(now.date() + timedelta(days=days_ahead + 7), at, tzinfo=tz)
+    if when <= now:
+        raise ValueError('That time is in the past.')
+    return to_server_time(when)
+
+# Parse a reminder time. Returns the first time the reminder fires (naive, server-local) and the
+# recurrence rule, or None for one-off reminders. Raises ValueError for anything it can't parse.
+
+
+def parse_reminder_time(reminder_time: str, tz=None):
+    try:
+        return parse_time_text(reminder_time, tz)
+    except OverflowError:
+        raise ValueError('That time is too far in the future.')
+
+
+def parse_time_text(reminder_time, tz):
+    text = reminder_time.strip().lower()
+
+    if duration_pattern.fullmatch(text):
+        seconds = duration_seconds(text)
+        if seconds == 0:
+            raise ValueError('The reminder time must be in the future.')
+        return datetime.now() + timedelta(seconds=seconds), None
+
+    match = weekly_pattern.fullmatch(text)
+    if match:
+        days = match.group('days')
+        if days in day_sets:
+            days = day_sets[days]
+        else:
+            days = ''.join(sorted({str(parse_day_name(name)) for name in day_split_pattern.split(days)}))
+        recurrence = f'weekly:{days}@{parse_clock(match).strftime("%H:%M")}'
+        return next_fire_time(recurrence, datetime.now(), tz), recurrence
+
+    match = interval_pattern.fullmatch(text)
+    if match:
+        seconds = duration_seconds(match.group('interval'))
+        if seconds < MIN_INTERVAL:
+            raise ValueError('Recurring reminders must be at least a minute apart.')
+        return datetime.now() + timedelta(seconds=seconds), f'interval:{seconds}'
+
+    match = absolute_pattern.fullmatch(text)
+    if match:
+        return parse_absolute_time(match, tz), None
+
+    raise ValueError(f"I couldn't understand the reminder time `{reminder_time}`.")
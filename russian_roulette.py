@@ -2,7 +2,9 @@ import logging
 import random
 import os
 import discord
+import stats
 from discord import app_commands
+from middleware import player_message
 from discord.ext import tasks, commands
 
 logging.basicConfig(level=logging.DEBUG)
@@ -37,12 +39,14 @@ class Roulette:
 async def roulette(interaction):   
         game = Roulette()
         await interaction.response.send_message("Are you ready to pull the trigger? Type `s` to continue or `q` to pussy out.")
-        msg = await client.wait_for('message')
+        msg = await interaction.client.wait_for('message', check=player_message(interaction))
         if msg.content.lower() != 'q':
             bullet, chamber = game.gun.pop(0)
             if bullet == 1 and chamber == 1:
                 await interaction.followup.send("BLAMMO! You are dead!")
+                await stats.record(interaction, 'roulette', 'loss')
             else:
                 await interaction.followup.send("Click! You survived!")
+                await stats.record(interaction, 'roulette', 'win')
         else:
             await interaction.followup.send("WIMP! You pussied out!")
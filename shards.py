@@ -0,0 +1,108 @@
+import os
+import signal
+import subprocess
+import sys
+import time
+import requests
+from dotenv import load_dotenv
+
+# Shard supervisor. Runs the bot as several worker processes, each one owning a slice of the
+# gateway shards. Workers only share state through MariaDB.
+#
+#   SHARD_COUNT    total number of shards (asks Discord for the recommended count when unset)
+#   SHARD_WORKERS  number of worker processes (defaults to one per shard)
+#
+# Each worker is started as `python main.py` with SHARD_COUNT and SHARD_IDS set.
+
+worker_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+gateway_url = 'https://discord.com/api/v10/gateway/bot'
+
+# Discord only allows one IDENTIFY every 5 seconds per bucket, so workers are started staggered.
+IDENTIFY_DELAY = 5
+MAX_RESTART_DELAY = 60
+
+
+def recommended_shard_count(token):
+    response = requests.get(gateway_url, headers={'Authorization': f'Bot {token}'}, timeout=10)
+    response.raise_for_status()
+    return response.json()['shards']
+
+# Read the shard settings a worker was started with. (None, None) means a single process
+# that lets discord.py pick the shard count itself.
+
+
+def shard_config():
+    shard_count = os.getenv('SHARD_COUNT')
+    shard_ids = os.getenv('SHARD_IDS')
+    return (int(shard_count) if shard_count else None,
+            [int(shard_id) for shard_id in shard_ids.split(',')] if shard_ids else None)
+
+def split_shards(shard_count, workers):
+    return [list(range(worker, shard_count, workers)) for worker in range(workers)]
+
+
+def spawn_worker(shard_count, shard_ids):
+    env = dict(os.environ, SHARD_COUNT=str(shard_count), SHARD_IDS=','.join(map(str, shard_ids)))
+    print(f'Starting worker for shards {shard_ids}')
+    return subprocess.Popen([sys.executable, worker_script], env=env)
+
+
+def main():
+    load_dotenv()
+    shard_count = int(os.getenv('SHARD_COUNT') or recommended_shard_count(os.getenv('DISCORD_TOKEN')))
+    workers = min(int(os.getenv('SHARD_WORKERS') or shard_count), shard_count)
+    groups = split_shards(shard_count, workers)
+    print(f'Running {shard_count} shards in {workers} worker processes')
+
+    processes = [None] * workers
+    started = [0.0] * workers
+    restart_delay = [IDENTIFY_DELAY] * workers
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for process in processes:
+            if process and process.poll() is None:
+                process.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for worker, shard_ids in enumerate(groups):
+        if stopping:
+            break
+        processes[worker] = spawn_worker(shard_count, shard_ids)
+        started[worker] = time.monotonic()
+        time.sleep(IDENTIFY_DELAY * len(shard_ids))
+
+    # Restart crashed workers, backing off if a worker keeps dying right after it starts. A worker
+    # only exits cleanly when it was shut down on purpose, by /shutdown or a signal, so then the
+    # whole bot is stopped instead.
+    while not stopping:
+        time.sleep(1)
+        for worker, process in enumerate(processes):
+            if stopping or process is None or process.poll() is None:
+                continue
+            if process.returncode == 0:
+                print(f'Worker for shards {groups[worker]} shut down, stopping the other workers')
+                stop(None, None)
+                break
+            lifetime = time.monotonic() - started[worker]
+            if lifetime > MAX_RESTART_DELAY:
+                restart_delay[worker] = IDENTIFY_DELAY
+            print(f'Worker for shards {groups[worker]} exited with code {process.returncode}, '
+                  f'restarting in {restart_delay[worker]}s')
+            time.sleep(restart_delay[worker])
+            restart_delay[worker] = min(restart_delay[worker] * 2, MAX_RESTART_DELAY)
+            if not stopping:
+                processes[worker] = spawn_worker(shard_count, groups[worker])
+                started[worker] = time.monotonic()
+
+    for process in processes:
+        if process:
+            process.wait()
+
+
+if __name__ == '__main__':
+    main()
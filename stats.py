@@ -0,0 +1,213 @@
+import asyncio
+import logging
+import discord
+import lifecycle
+from collections import OrderedDict
+from discord import app_commands
+from discord.ext import tasks
+from storage import get_storage
+
+logging.basicConfig(level=logging.DEBUG)
+discord_logger = logging.getLogger('discord')
+discord_logger.setLevel(logging.DEBUG)
+
+intents = discord.Intents.all()
+intents.members = True
+client = discord.Client(intents=intents)
+tree = app_commands.CommandTree(client)
+
+# Game statistics. Every finished game is counted per guild, user and game: wins, losses, ties, the
+# current win streak (losses reset it, ties don't) and the best streak.
+#
+# Results are written behind. A game only updates memory and adds to `pending`, and flush_pending()
+# writes everything pending to the database as one batched upsert every FLUSH_INTERVAL seconds and
+# when the bot drains. Counts are written as increments, so the database stays right even if two
+# processes flush results for the same player.
+
+FLUSH_INTERVAL = 30
+LEADERBOARD_SIZE = 10
+RECORD_CACHE_SIZE = 10000
+GAMES = ('blackjack', 'poker', 'roulette')
+OUTCOMES = ('win', 'loss', 'tie')
+
+
+class PlayerStats:
+    __slots__ = ('wins', 'losses', 'ties', 'streak', 'best_streak')
+
+    def __init__(self, row=None):
+        self.wins, self.losses, self.ties, self.streak, self.best_streak = row or (0, 0, 0, 0, 0)
+
+    def add(self, outcome):
+        if outcome == 'win':
+            self.wins += 1
+            self.streak += 1
+            self.best_streak = max(self.best_streak, self.streak)
+        elif outcome == 'loss':
+            self.losses += 1
+            self.streak = 0
+        else:
+            self.ties += 1
+
+# Leaderboards are kept in memory as the top LEADERBOARD_SIZE players of each guild and game, loaded
+# once from the (guild_id, game, wins) index and then kept up to date as games finish. Wins only ever
+# go up, so a player can only join the board by beating its lowest entry, and showing a board never
+# sorts more than LEADERBOARD_SIZE rows. A guild's interactions all arrive on one shard, so the
+# process that owns the guild sees every game that can change its boards.
+
+
+class Leaderboard:
+    __slots__ = ('entries',)
+
+    def __init__(self, rows):
+        self.entries = {user_id: (wins, losses, ties, best_streak) for user_id, wins, losses, ties, best_streak in rows}
+
+    def update(self, user_id, stats):
+        entry = (stats.wins, stats.losses, stats.ties, stats.best_streak)
+        if user_id in self.entries or len(self.entries) < LEADERBOARD_SIZE:
+            self.entries[user_id] = entry
+            return
+        lowest = min(self.entries, key=lambda member: self.entries[member][0])
+        if stats.wins > self.entries[lowest][0]:
+            del self.entries[lowest]
+            self.entries[user_id] = entry
+
+    def top(self):
+        return sorted(self.entries.items(), key=lambda item: item[1][0], reverse=True)
+
+
+# Player stats that have been looked up, in least recently used order, keyed by (guild_id, user_id, game).
+records = OrderedDict()
+# Results not yet written to the database: (guild_id, user_id, game) -> [wins, losses, ties, streak,
+# best_streak]. The streaks are copied here as games finish, so writing a batch never needs `records`.
+pending = {}
+# Batches taken from `pending` that are being written right now.
+writing = []
+# Leaderboards keyed by (guild_id, game).
+boards = {}
+
+
+async def get_player_stats(key, store):
+    stats = records.get(key)
+    if stats is None:
+        row = await store.get_game_stats(*key)
+        stats = records.setdefault(key, PlayerStats(row))
+    records.move_to_end(key)
+    return stats
+
+
+async def get_leaderboard(guild_id, game, store):
+    board = boards.get((guild_id, game))
+    if board is None:
+        rows = await store.top_players(guild_id, game, LEADERBOARD_SIZE)
+        board = boards.setdefault((guild_id, game), Leaderboard(rows))
+    return board
+
+# Record the outcome of a game: 'win', 'loss' or 'tie'. Games played in DMs have no guild and aren't
+# counted. A database error here must never break the game, so it is only logged.
+
+
+async def record(interaction, game, outcome):
+    if interaction.guild_id is None:
+        return
+    key = (interaction.guild_id, interaction.user.id, game)
+    try:
+        store = await get_storage()
+        # Load the board before the player's stats change, so the change is applied to it.
+        board = await get_leaderboard(interaction.guild_id, game, store)
+        stats = await get_player_stats(key, store)
+    except Exception as e:
+        print(f"Error recording {game} result: {e}")
+        return
+    stats.add(outcome)
+    counts = pending.setdefault(key, [0, 0, 0, 0, 0])
+    counts[OUTCOMES.index(outcome)] += 1
+    counts[3:] = stats.streak, stats.best_streak
+    board.update(interaction.user.id, stats)
+
+
+async def flush_pending():
+    global pending
+    if not pending:
+        return
+    batch, pending = pending, {}
+    rows = [(*key, *counts) for key, counts in batch.items()]
+    # Shielded so that cancelling the flush task at shutdown can't lose a batch halfway through.
+    await asyncio.shield(write_batch(batch, rows))
+
+
+async def write_batch(batch, rows):
+    writing.append(batch)
+    try:
+        store = await get_storage()
+        await store.upsert_game_stats(rows)
+    except Exception as e:
+        print(f"Error writing game stats, will retry: {e}")
+        # Put the counts back. Games may have finished since the batch was taken, and a later batch
+        # may already have written their streaks, so the streaks come from the player's current stats.
+        for key, counts in batch.items():
+            merged = pending.setdefault(key, [0, 0, 0, *counts[3:]])
+            for index in range(3):
+                merged[index] += counts[index]
+            stats = records.get(key)
+            if stats is not None:
+                merged[3:] = stats.streak, stats.best_streak
+        return
+    finally:
+        writing.remove(batch)
+    evict_records()
+
+
+def evict_records():
+    # Stats with unwritten results stay in memory: reloading them from the database would miss the
+    # pending results. That includes results in a batch that is still being written.
+    if len(records) <= RECORD_CACHE_SIZE:
+        return
+    for key in list(records):
+        if len(records) <= RECORD_CACHE_SIZE:
+            break
+        if key not in pending and not any(key in batch for batch in writing):
+            del records[key]
+
+
+@tasks.loop(seconds=FLUSH_INTERVAL)
+async def flush_stats():
+    await flush_pending()
+
+
+lifecycle.register_flush(flush_pending)
+
+game_choices = [app_commands.Choice(name=game, value=game) for game in GAMES]
+
+# Leaderboard command. Shows the top players of a game in this server.
+
+@tree.command(name='leaderboard', description='Show the top players of a game in this server')
+@app_commands.choices(game=game_choices)
+async def leaderboard(interaction, game: str):
+    if interaction.guild_id is None:
+        await interaction.response.send_message('Leaderboards are only kept in servers.')
+        return
+    board = await get_leaderboard(interaction.guild_id, game, await get_storage())
+    top = board.top()
+    if not top:
+        await interaction.response.send_message(f'Nobody has played {game} here yet.')
+        return
+    lines = [f'{rank}. <@{user_id}>: {wins} wins, {losses} losses, {ties} ties, best streak {best_streak}'
+             for rank, (user_id, (wins, losses, ties, best_streak)) in enumerate(top, start=1)]
+    await interaction.response.send_message(f'**{game.title()} leaderboard**\n' + '\n'.join(lines),
+                                            allowed_mentions=discord.AllowedMentions.none())
+
+# Stats command. Shows your own results in this server.
+
+@tree.command(name='stats', description='Show your game stats in this server')
+async def gamestats(interaction):
+    if interaction.guild_id is None:
+        await interaction.response.send_message('Game stats are only kept in servers.')
+        return
+    store = await get_storage()
+    lines = []
+    for game in GAMES:
+        stats = await get_player_stats((interaction.guild_id, interaction.user.id, game), store)
+        if stats.wins or stats.losses or stats.ties:
+            lines.append(f'{game.title()}: {stats.wins} wins, {stats.losses} losses, {stats.ties} ties, '
+                         f'current streak {stats.streak}, best streak {stats.best_streak}')
+    await interaction.response.send_message('\n'.join(lines) or 'You have not played any games here yet.')
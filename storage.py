@@ -0,0 +1,611 @@
+import asyncio
+import os
+import queue
+import random
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from db import get_pool, close_pool
+from migrations import migration_lock, run_migrations, run_sqlite_migrations
+
+# Storage backends. Everything the bot keeps in a database goes through a Storage object, so the
+# commands run unchanged against MariaDB or an embedded SQLite file.
+#
+#   STORAGE_BACKEND  mariadb (the default) or sqlite
+#   SQLITE_PATH      the SQLite database file, data/exodus2.db by default
+#
+# All datetimes going in and out are naive server-local datetimes.
+
+
+class Storage(ABC):
+    @abstractmethod
+    async def open(self):
+        ...
+
+    @abstractmethod
+    async def close(self):
+        ...
+
+    @abstractmethod
+    async def ping(self):
+        ...
+
+    # Users. get_user returns (location, unit, timezone), or None for users that have never set
+    # anything.
+
+    @abstractmethod
+    async def get_user(self, user_id):
+        ...
+
+    @abstractmethod
+    async def set_user_location(self, user_id, location):
+        ...
+
+    @abstractmethod
+    async def set_user_unit(self, user_id, unit):
+        ...
+
+    @abstractmethod
+    async def set_user_timezone(self, user_id, timezone):
+        ...
+
+    # Reminders. Claimed rows are (id, user_id, reminder, remind_time, recurrence, timezone, claim).
+    # take_reminder moves a claimed reminder to retry_time before it is sent. It, complete_reminder,
+    # reschedule_reminder and cancel_reminder return whether the reminder was still there to change.
+    # list_reminders pages through a user's reminders in (remind_time, id) order, starting after the
+    # (remind_time, id) of the last row of the previous page, and returns rows of
+    # (id, reminder, remind_time, recurrence).
+
+    @abstractmethod
+    async def add_reminder(self, user_id, reminder, remind_time, recurrence, timezone):
+        ...
+
+    @abstractmethod
+    async def claim_reminders(self, claim, until, lease_seconds, limit):
+        ...
+
+    @abstractmethod
+    async def take_reminder(self, reminder_id, claim, retry_time):
+        ...
+
+    @abstractmethod
+    async def complete_reminder(self, reminder_id, claim):
+        ...
+
+    @abstractmethod
+    async def reschedule_reminder(self, reminder_id, claim, next_time):
+        ...
+
+    @abstractmethod
+    async def list_reminders(self, user_id, after, limit):
+        ...
+
+    @abstractmethod
+    async def cancel_reminder(self, user_id, reminder_id):
+        ...
+
+    # Quotes. Rows are (id, quote).
+
+    @abstractmethod
+    async def seed_quotes(self, quotes):
+        ...
+
+    @abstractmethod
+    async def add_quote(self, text, author, user_id):
+        ...
+
+    @abstractmethod
+    async def search_quotes(self, text, limit):
+        ...
+
+    @abstractmethod
+    async def quotes_by_author(self, author, limit):
+        ...
+
+    @abstractmethod
+    async def max_quote_id(self):
+        ...
+
+    @abstractmethod
+    async def quote_at_or_after(self, quote_id):
+        ...
+
+    # Game stats. get_game_stats returns (wins, losses, ties, streak, best_streak), or None.
+    # upsert_game_stats takes rows of (guild_id, user_id, game, wins, losses, ties, streak,
+    # best_streak) where wins, losses and ties are added to the stored counts and the streaks replace
+    # them. top_players returns (user_id, wins, losses, ties, best_streak) rows, most wins first.
+
+    @abstractmethod
+    async def get_game_stats(self, guild_id, user_id, game):
+        ...
+
+    @abstractmethod
+    async def upsert_game_stats(self, rows):
+        ...
+
+    @abstractmethod
+    async def top_players(self, guild_id, game, limit):
+        ...
+
+    # Pick random quotes without ORDER BY RAND(): draw a random id up to the highest id and seek to
+    # the first quote at or after it. Both lookups use the primary key, so the cost does not grow
+    # with the size of the table.
+
+    async def random_quotes(self, count):
+        max_id = await self.max_quote_id()
+        if not max_id:
+            return []
+        found = {}
+        for _ in range(count):
+            row = await self.quote_at_or_after(random.randint(1, max_id))
+            if row:
+                found[row[0]] = row[1]
+        return list(found.values())
+
+
+class MariaDBStorage(Storage):
+    async def open(self):
+        await run_migrations(await get_pool())
+
+    async def close(self):
+        await close_pool()
+
+    async def execute(self, sql, args=()):
+        pool = await get_pool()
+        async with pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(sql, args)
+                return cur.rowcount, cur.lastrowid
+
+    async def fetchone(self, sql, args=()):
+        pool = await get_pool()
+        async with pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(sql, args)
+                return await cur.fetchone()
+
+    async def fetchall(self, sql, args=()):
+        pool = await get_pool()
+        async with pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(sql, args)
+                return await cur.fetchall()
+
+    async def ping(self):
+        await self.fetchone('SELECT 1')
+
+    async def get_user(self, user_id):
+        return await self.fetchone('SELECT location, unit, timezone FROM users WHERE id = %s', (user_id,))
+
+    async def set_user_location(self, user_id, location):
+        await self.execute('INSERT INTO users (id, location) VALUES (%s, %s) ON DUPLICATE KEY UPDATE location = VALUES(location)',
+                           (user_id, location))
+
+    async def set_user_unit(self, user_id, unit):
+        await self.execute('INSERT INTO users (id, unit) VALUES (%s, %s) ON DUPLICATE KEY UPDATE unit = VALUES(unit)',
+                           (user_id, unit))
+
+    async def set_user_timezone(self, user_id, timezone):
+        await self.execute('INSERT INTO users (id, timezone) VALUES (%s, %s) ON DUPLICATE KEY UPDATE timezone = VALUES(timezone)',
+                           (user_id, timezone))
+
+    async def add_reminder(self, user_id, reminder, remind_time, recurrence, timezone):
+        rowcount, reminder_id = await self.execute(
+            'INSERT INTO reminders (user_id, reminder, remind_time, recurrence, timezone) VALUES (%s, %s, %s, %s, %s)',
+            (user_id, reminder, remind_time, recurrence, timezone))
+        return reminder_id
+
+    async def claim_reminders(self, claim, until, lease_seconds, limit):
+        now = datetime.now()
+        rowcount, _ = await self.execute('''
+            UPDATE reminders
+            SET claimed_by = %s, claim_expires = GREATEST(remind_time, %s) + INTERVAL %s SECOND
+            WHERE remind_time <= %s AND (claim_expires IS NULL OR claim_expires < %s)
+            ORDER BY remind_time LIMIT %s
+        ''', (claim, now, lease_seconds, until, now, limit))
+        if rowcount == 0:
+            return []
+        return await self.fetchall('''
+            SELECT id, user_id, reminder, remind_time, recurrence, timezone, claimed_by
+            FROM reminders WHERE claimed_by = %s
+        ''', (claim,))
+
+    async def take_reminder(self, reminder_id, claim, retry_time):
+        rowcount, _ = await self.execute('UPDATE reminders SET remind_time = %s WHERE id = %s AND claimed_by = %s',
+                                         (retry_time, reminder_id, claim))
+        return rowcount > 0
+
+    async def complete_reminder(self, reminder_id, claim):
+        rowcount, _ = await self.execute('DELETE FROM reminders WHERE id = %s AND claimed_by = %s', (reminder_id, claim))
+        return rowcount > 0
+
+    async def reschedule_reminder(self, reminder_id, claim, next_time):
+        rowcount, _ = await self.execute('''
+            UPDATE reminders SET remind_time = %s, claimed_by = NULL, claim_expires = NULL
+            WHERE id = %s AND claimed_by = %s
+        ''', (next_time, reminder_id, claim))
+        return rowcount > 0
+
+    async def list_reminders(self, user_id, after, limit):
+        # Keyset pagination on the (user_id, remind_time, id) index: every page is an index range
+        # scan, however deep into the list it is. The row comparison is written out because MariaDB
+        # doesn't use an index for (remind_time, id) > (%s, %s).
+        if after is None:
+            return await self.fetchall('''
+                SELECT id, reminder, remind_time, recurrence FROM reminders
+                WHERE user_id = %s ORDER BY remind_time, id LIMIT %s
+            ''', (user_id, limit))
+        after_time, after_id = after
+        return await self.fetchall('''
+            SELECT id, reminder, remind_time, recurrence FROM reminders
+            WHERE user_id = %s AND (remind_time > %s OR (remind_time = %s AND id > %s))
+            ORDER BY remind_time, id LIMIT %s
+        ''', (user_id, after_time, after_time, after_id, limit))
+
+    async def cancel_reminder(self, user_id, reminder_id):
+        rowcount, _ = await self.execute('DELETE FROM reminders WHERE id = %s AND user_id = %s', (reminder_id, user_id))
+        return rowcount > 0
+
+    async def seed_quotes(self, quotes):
+        # Every worker seeds on startup. The check and the insert run under the migration lock, so
+        # workers starting together can't each find the table empty and insert the quotes twice.
+        pool = await get_pool()
+        async with pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                async with migration_lock(cur):
+                    await cur.execute('SELECT 1 FROM quotes LIMIT 1')
+                    if await cur.fetchone():
+                        return
+                    await cur.executemany('INSERT INTO quotes (quote, author, added_at) VALUES (%s, %s, %s)',
+                                          [(text, author, datetime.now()) for text, author in quotes])
+
+    async def add_quote(self, text, author, user_id):
+        rowcount, quote_id = await self.execute('INSERT INTO quotes (quote, author, added_by, added_at) VALUES (%s, %s, %s, %s)',
+                                                (text, author, user_id, datetime.now()))
+        return quote_id
+
+    async def search_quotes(self, text, limit):
+        return await self.fetchall('SELECT id, quote FROM quotes WHERE MATCH(quote) AGAINST (%s IN NATURAL LANGUAGE MODE) LIMIT %s',
+                                   (text, limit))
+
+    async def quotes_by_author(self, author, limit):
+        return await self.fetchall('SELECT id, quote FROM quotes WHERE author = %s ORDER BY id DESC LIMIT %s', (author, limit))
+
+    async def max_quote_id(self):
+        row = await self.fetchone('SELECT MAX(id) FROM quotes')
+        return row[0] if row else None
+
+    async def quote_at_or_after(self, quote_id):
+        return await self.fetchone('SELECT id, quote FROM quotes WHERE id >= %s ORDER BY id LIMIT 1', (quote_id,))
+
+    async def get_game_stats(self, guild_id, user_id, game):
+        return await self.fetchone('''
+            SELECT wins, losses, ties, streak, best_streak FROM game_stats
+            WHERE guild_id = %s AND user_id = %s AND game = %s
+        ''', (guild_id, user_id, game))
+
+    async def upsert_game_stats(self, rows):
+        # executemany turns this into a single multi-row INSERT.
+        now = datetime.now()
+        pool = await get_pool()
+        async with pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.executemany('''
+                    INSERT INTO game_stats (guild_id, user_id, game, wins, losses, ties, streak, best_streak, updated_at)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+                    ON DUPLICATE KEY UPDATE
+                        wins = wins + VALUES(wins), losses = losses + VALUES(losses), ties = ties + VALUES(ties),
+                        streak = VALUES(streak), best_streak = GREATEST(best_streak, VALUES(best_streak)),
+                        updated_at = VALUES(updated_at)
+                ''', [(*row, now) for row in rows])
+
+    async def top_players(self, guild_id, game, limit):
+        return await self.fetchall('''
+            SELECT user_id, wins, losses, ties, best_streak FROM game_stats
+            WHERE guild_id = %s AND game = %s ORDER BY wins DESC LIMIT %s
+        ''', (guild_id, game, limit))
+
+# Embedded SQLite backend for small single-node deployments, where a network round trip to MariaDB
+# costs more than the query itself. The database runs in WAL mode so reads never wait for writes.
+# Reads run on their own connection in a single reader thread. Writes are queued to a dedicated
+# writer thread, which commits everything waiting in the queue as one transaction, each write in its
+# own savepoint so one failing write doesn't undo the others. A write's result is only returned once
+# its transaction has committed.
+
+WRITE_BATCH = 256
+
+
+def to_text(when):
+    return when.isoformat(sep=' ', timespec='seconds') if when else None
+
+
+def from_text(text):
+    return datetime.fromisoformat(text) if text else None
+
+
+class SQLiteStorage(Storage):
+    def __init__(self, path):
+        self.path = path
+        self.writes = queue.Queue()
+        self.writer = None
+        self.reader = None
+        self.read_conn = None
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA busy_timeout=5000')
+        return conn
+
+    async def open(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        write_conn = self.connect()
+        await asyncio.to_thread(run_sqlite_migrations, write_conn)
+        self.writer = threading.Thread(target=self.run_writer, args=(write_conn,), name='sqlite-writer', daemon=True)
+        self.writer.start()
+        self.read_conn = self.connect()
+        self.reader = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite-reader')
+
+    async def close(self):
+        # Let the writer commit everything still queued before it stops.
+        self.writes.put(None)
+        await asyncio.to_thread(self.writer.join)
+        self.reader.shutdown()
+        self.read_conn.close()
+
+    def run_writer(self, conn):
+        stopping = False
+        while not stopping:
+            item = self.writes.get()
+            if item is None:
+                break
+            batch = [item]
+            while len(batch) < WRITE_BATCH:
+                try:
+                    item = self.writes.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            try:
+                results = self.commit_batch(conn, batch)
+            except Exception as e:
+                # The batch couldn't be started or committed, for instance because another connection
+                # held the database locked past busy_timeout. Fail every write in it and keep going,
+                # so later writes still get an answer.
+                print(f"Error committing SQLite writes: {e}")
+                try:
+                    if conn.in_transaction:
+                        conn.execute('ROLLBACK')
+                except sqlite3.Error as rollback_error:
+                    print(f"Error rolling back SQLite writes: {rollback_error}")
+                results = [(loop, future, None, e) for write, loop, future in batch]
+            for loop, future, result, error in results:
+                loop.call_soon_threadsafe(resolve, future, result, error)
+        conn.close()
+
+    def commit_batch(self, conn, batch):
+        results = []
+        conn.execute('BEGIN IMMEDIATE')
+        for write, loop, future in batch:
+            conn.execute('SAVEPOINT write')
+            try:
+                results.append((loop, future, write(conn), None))
+                conn.execute('RELEASE write')
+            except Exception as e:
+                conn.execute('ROLLBACK TO write')
+                conn.execute('RELEASE write')
+                results.append((loop, future, None, e))
+        conn.execute('COMMIT')
+        return results
+
+    async def write(self, write):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.writes.put((write, loop, future))
+        return await future
+
+    async def read(self, read):
+        return await asyncio.get_running_loop().run_in_executor(self.reader, read, self.read_conn)
+
+    async def execute(self, sql, args=()):
+        def write(conn):
+            cur = conn.execute(sql, args)
+            return cur.rowcount, cur.lastrowid
+        return await self.write(write)
+
+    async def fetchone(self, sql, args=()):
+        return await self.read(lambda conn: conn.execute(sql, args).fetchone())
+
+    async def fetchall(self, sql, args=()):
+        return await self.read(lambda conn: conn.execute(sql, args).fetchall())
+
+    async def ping(self):
+        await self.fetchone('SELECT 1')
+
+    async def get_user(self, user_id):
+        return await self.fetchone('SELECT location, unit, timezone FROM users WHERE id = ?', (user_id,))
+
+    async def set_user_location(self, user_id, location):
+        await self.execute('INSERT INTO users (id, location) VALUES (?, ?) ON CONFLICT (id) DO UPDATE SET location = excluded.location',
+                           (user_id, location))
+
+    async def set_user_unit(self, user_id, unit):
+        await self.execute('INSERT INTO users (id, unit) VALUES (?, ?) ON CONFLICT (id) DO UPDATE SET unit = excluded.unit',
+                           (user_id, unit))
+
+    async def set_user_timezone(self, user_id, timezone):
+        await self.execute('INSERT INTO users (id, timezone) VALUES (?, ?) ON CONFLICT (id) DO UPDATE SET timezone = excluded.timezone',
+                           (user_id, timezone))
+
+    async def add_reminder(self, user_id, reminder, remind_time, recurrence, timezone):
+        rowcount, reminder_id = await self.execute(
+            'INSERT INTO reminders (user_id, reminder, remind_time, recurrence, timezone) VALUES (?, ?, ?, ?, ?)',
+            (user_id, reminder, to_text(remind_time), recurrence, timezone))
+        return reminder_id
+
+    async def claim_reminders(self, claim, until, lease_seconds, limit):
+        now = to_text(datetime.now())
+
+        def write(conn):
+            conn.execute('''
+                UPDATE reminders
+                SET claimed_by = ?, claim_expires = datetime(max(remind_time, ?), ?)
+                WHERE id IN (
+                    SELECT id FROM reminders
+                    WHERE remind_time <= ? AND (claim_expires IS NULL OR claim_expires < ?)
+                    ORDER BY remind_time LIMIT ?
+                )
+            ''', (claim, now, f'+{lease_seconds} seconds', to_text(until), now, limit))
+            return conn.execute('''
+                SELECT id, user_id, reminder, remind_time, recurrence, timezone, claimed_by
+                FROM reminders WHERE claimed_by = ?
+            ''', (claim,)).fetchall()
+        rows = await self.write(write)
+        return [(reminder_id, user_id, reminder, from_text(remind_time), recurrence, timezone, claimed_by)
+                for reminder_id, user_id, reminder, remind_time, recurrence, timezone, claimed_by in rows]
+
+    async def take_reminder(self, reminder_id, claim, retry_time):
+        rowcount, _ = await self.execute('UPDATE reminders SET remind_time = ? WHERE id = ? AND claimed_by = ?',
+                                         (to_text(retry_time), reminder_id, claim))
+        return rowcount > 0
+
+    async def complete_reminder(self, reminder_id, claim):
+        rowcount, _ = await self.execute('DELETE FROM reminders WHERE id = ? AND claimed_by = ?', (reminder_id, claim))
+        return rowcount > 0
+
+    async def reschedule_reminder(self, reminder_id, claim, next_time):
+        rowcount, _ = await self.execute('''
+            UPDATE reminders SET remind_time = ?, claimed_by = NULL, claim_expires = NULL
+            WHERE id = ? AND claimed_by = ?
+        ''', (to_text(next_time), reminder_id, claim))
+        return rowcount > 0
+
+    async def list_reminders(self, user_id, after, limit):
+        if after is None:
+            rows = await self.fetchall('''
+                SELECT id, reminder, remind_time, recurrence FROM reminders
+                WHERE user_id = ? ORDER BY remind_time, id LIMIT ?
+            ''', (user_id, limit))
+        else:
+            after_time, after_id = after
+            rows = await self.fetchall('''
+                SELECT id, reminder, remind_time, recurrence FROM reminders
+                WHERE user_id = ? AND (remind_time, id) > (?, ?)
+                ORDER BY remind_time, id LIMIT ?
+            ''', (user_id, to_text(after_time), after_id, limit))
+        return [(reminder_id, reminder, from_text(remind_time), recurrence)
+                for reminder_id, reminder, remind_time, recurrence in rows]
+
+    async def cancel_reminder(self, user_id, reminder_id):
+        rowcount, _ = await self.execute('DELETE FROM reminders WHERE id = ? AND user_id = ?', (reminder_id, user_id))
+        return rowcount > 0
+
+    async def seed_quotes(self, quotes):
+        def write(conn):
+            if conn.execute('SELECT 1 FROM quotes LIMIT 1').fetchone():
+                return
+            conn.executemany('INSERT INTO quotes (quote, author, added_at) VALUES (?, ?, ?)',
+                             [(text, author, to_text(datetime.now())) for text, author in quotes])
+        await self.write(write)
+
+    async def add_quote(self, text, author, user_id):
+        rowcount, quote_id = await self.execute('INSERT INTO quotes (quote, author, added_by, added_at) VALUES (?, ?, ?, ?)',
+                                                (text, author, user_id, to_text(datetime.now())))
+        return quote_id
+
+    async def search_quotes(self, text, limit):
+        # Quote every word so punctuation in the search can't be read as FTS5 query syntax, and
+        # match any of them, like MariaDB's natural language mode.
+        query = ' OR '.join('"' + word.replace('"', '""') + '"' for word in text.split())
+        if not query:
+            return []
+        return await self.fetchall('''
+            SELECT quotes.id, quotes.quote FROM quotes_fts
+            JOIN quotes ON quotes.id = quotes_fts.rowid
+            WHERE quotes_fts MATCH ? ORDER BY rank LIMIT ?
+        ''', (query, limit))
+
+    async def quotes_by_author(self, author, limit):
+        return await self.fetchall('SELECT id, quote FROM quotes WHERE author = ? ORDER BY id DESC LIMIT ?', (author, limit))
+
+    async def max_quote_id(self):
+        row = await self.fetchone('SELECT MAX(id) FROM quotes')
+        return row[0] if row else None
+
+    async def quote_at_or_after(self, quote_id):
+        return await self.fetchone('SELECT id, quote FROM quotes WHERE id >= ? ORDER BY id LIMIT 1', (quote_id,))
+
+    async def get_game_stats(self, guild_id, user_id, game):
+        return await self.fetchone('''
+            SELECT wins, losses, ties, streak, best_streak FROM game_stats
+            WHERE guild_id = ? AND user_id = ? AND game = ?
+        ''', (guild_id, user_id, game))
+
+    async def upsert_game_stats(self, rows):
+        now = to_text(datetime.now())
+
+        def write(conn):
+            conn.executemany('''
+                INSERT INTO game_stats (guild_id, user_id, game, wins, losses, ties, streak, best_streak, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (guild_id, user_id, game) DO UPDATE SET
+                    wins = wins + excluded.wins, losses = losses + excluded.losses, ties = ties + excluded.ties,
+                    streak = excluded.streak, best_streak = max(best_streak, excluded.best_streak),
+                    updated_at = excluded.updated_at
+            ''', [(*row, now) for row in rows])
+        await self.write(write)
+
+    async def top_players(self, guild_id, game, limit):
+        return await self.fetchall('''
+            SELECT user_id, wins, losses, ties, best_streak FROM game_stats
+            WHERE guild_id = ? AND game = ? ORDER BY wins DESC LIMIT ?
+        ''', (guild_id, game, limit))
+
+
+def resolve(future, result, error):
+    if future.cancelled():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+# The storage backend picked by STORAGE_BACKEND. It is opened (and migrated) on first use.
+
+
+def create_storage():
+    backend = os.getenv('STORAGE_BACKEND', 'mariadb').lower()
+    if backend == 'sqlite':
+        return SQLiteStorage(os.getenv('SQLITE_PATH', 'data/exodus2.db'))
+    if backend == 'mariadb':
+        return MariaDBStorage()
+    raise ValueError(f'Unknown STORAGE_BACKEND {backend}')
+
+
+storage = None
+storage_lock = asyncio.Lock()
+
+
+async def get_storage():
+    global storage
+    if storage is not None:
+        return storage
+    async with storage_lock:
+        if storage is None:
+            opened = create_storage()
+            await opened.open()
+            storage = opened
+    return storage
+
+
+async def close_storage():
+    global storage
+    if storage is not None:
+        await storage.close()
+        storage = None
@@ -0,0 +1,53 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import MariaDBStorage, SQLiteStorage
+
+# Storage tests run against every backend. SQLite always runs, in a temporary file. MariaDB only runs
+# when DB_HOST (and the other DB_* settings) point at a database, and the tests empty its tables, so
+# point them at a scratch database.
+
+TABLES = ('reminders', 'users', 'quotes', 'game_stats')
+
+
+def mariadb_configured():
+    return bool(os.getenv('DB_HOST'))
+
+
+async def open_storage(backend, path):
+    if backend == 'sqlite':
+        store = SQLiteStorage(path)
+        await store.open()
+        return store
+    store = MariaDBStorage()
+    await store.open()
+    for table in TABLES:
+        await store.execute(f'DELETE FROM {table}')
+    return store
+
+
+@pytest.fixture(params=['sqlite', 'mariadb'])
+def backend(request):
+    if request.param == 'mariadb' and not mariadb_configured():
+        pytest.skip('DB_HOST is not set')
+    return request.param
+
+# with_storage(scenario) opens a fresh store, runs `await scenario(store)` and closes the store again.
+
+
+@pytest.fixture
+def with_storage(backend, tmp_path):
+    def run(scenario):
+        async def main():
+            store = await open_storage(backend, str(tmp_path / 'test.db'))
+            try:
+                await scenario(store)
+            finally:
+                await store.close()
+        asyncio.run(main())
+    return run
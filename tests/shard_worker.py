@@ -0,0 +1,20 @@
+import os
+import runpy
+import sys
+
+import yarl
+from discord.gateway import DiscordWebSocket
+from discord.http import Route
+
+# Runs main.py as a shard worker against the fake Discord in test_shards.py. Only discord.py's API
+# base and gateway URL are changed: main.py builds its AutoShardedClient from shard_config() exactly
+# as it does in production. The gateway URL carries the process id, so the fake gateway can tell
+# which worker each session belongs to.
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+fake_url = os.environ['FAKE_DISCORD_URL']
+Route.BASE = fake_url + '/api/v10'
+DiscordWebSocket.DEFAULT_GATEWAY = yarl.URL(fake_url.replace('http', 'ws', 1) + f'/gateway/{os.getpid()}/')
+
+sys.path.insert(0, root)
+runpy.run_path(os.path.join(root, 'main.py'), run_name='__main__')
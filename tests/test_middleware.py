@@ -0,0 +1,63 @@
+import asyncio
+from datetime import timedelta
+from types import SimpleNamespace
+
+import discord
+import pytest
+
+import middleware
+from middleware import DeadlineResponse, player_message
+
+# A command that hasn't answered by DEFER_AFTER is deferred automatically, ephemerally for the
+# commands that only answer ephemerally.
+
+
+class FakeInteraction:
+    def __init__(self):
+        self.created_at = discord.utils.utcnow() - timedelta(seconds=middleware.DEFER_AFTER)
+
+
+@pytest.mark.parametrize('command_name, ephemeral', [
+    ('reminders list', True),
+    ('reminders cancel', True),
+    ('weather', False),
+])
+def test_automatic_defer_visibility(monkeypatch, command_name, ephemeral):
+    deferred = []
+
+    async def defer(self, **kwargs):
+        deferred.append(kwargs)
+        self._response_type = discord.InteractionResponseType.deferred_channel_message
+    monkeypatch.setattr(discord.InteractionResponse, 'defer', defer)
+
+    response = DeadlineResponse(FakeInteraction())
+    asyncio.run(response.defer_before_deadline(command_name))
+    assert deferred == [{'ephemeral': ephemeral}]
+    assert response.is_done()
+
+
+def test_no_automatic_defer_after_response(monkeypatch):
+    deferred = []
+
+    async def defer(self, **kwargs):
+        deferred.append(kwargs)
+    monkeypatch.setattr(discord.InteractionResponse, 'defer', defer)
+
+    response = DeadlineResponse(FakeInteraction())
+    response._response_type = discord.InteractionResponseType.channel_message
+    asyncio.run(response.defer_before_deadline('reminders list'))
+    assert deferred == []
+
+
+def test_player_message_only_accepts_the_players_moves():
+    class Interaction:
+        user = SimpleNamespace(id=1)
+        channel_id = 10
+
+    def message(author_id, channel_id):
+        return SimpleNamespace(author=SimpleNamespace(id=author_id), channel=SimpleNamespace(id=channel_id))
+
+    check = player_message(Interaction())
+    assert check(message(1, 10))
+    assert not check(message(2, 10))
+    assert not check(message(1, 11))
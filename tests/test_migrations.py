@@ -0,0 +1,78 @@
+import asyncio
+
+import pytest
+
+import migrations
+from conftest import mariadb_configured
+from db import close_pool, get_pool
+
+# run_migrations() must not touch the schema unless it holds the migration lock.
+
+
+class FakeCursor:
+    def __init__(self, lock_result):
+        self.lock_result = lock_result
+        self.statements = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+    async def execute(self, sql, args=None):
+        self.statements.append(sql)
+
+    async def fetchone(self):
+        return (self.lock_result,)
+
+    async def fetchall(self):
+        return []
+
+
+class FakePool:
+    def __init__(self, cursor):
+        self.fake_cursor = cursor
+
+    def acquire(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+    def cursor(self):
+        return self.fake_cursor
+
+
+@pytest.mark.parametrize('lock_result', [0, None])
+def test_migrations_abort_without_lock(lock_result):
+    cursor = FakeCursor(lock_result)
+    with pytest.raises(RuntimeError):
+        asyncio.run(migrations.run_migrations(FakePool(cursor)))
+    assert not any('schema_migrations (version' in sql or 'RELEASE_LOCK' in sql for sql in cursor.statements)
+    assert not any(sql in cursor.statements for _, _, statements in migrations.migrations for sql in statements)
+
+
+@pytest.mark.skipif(not mariadb_configured(), reason='DB_HOST is not set')
+def test_migrations_wait_for_lock_held_elsewhere(monkeypatch):
+    monkeypatch.setattr(migrations, 'MIGRATION_LOCK_TIMEOUT', 1)
+
+    async def main():
+        pool = await get_pool()
+        try:
+            # GET_LOCK belongs to a connection, so holding it on one of the pool's connections blocks
+            # run_migrations() on another.
+            async with pool.acquire() as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute("SELECT GET_LOCK('exodus2_migrations', 10)")
+                    assert (await cur.fetchone())[0] == 1
+                    with pytest.raises(RuntimeError):
+                        await migrations.run_migrations(pool)
+                    await cur.execute("SELECT RELEASE_LOCK('exodus2_migrations')")
+            await migrations.run_migrations(pool)
+        finally:
+            await close_pool()
+    asyncio.run(main())
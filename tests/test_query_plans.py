@@ -0,0 +1,134 @@
+import asyncio
+import re
+from datetime import datetime, timedelta
+
+import pytest
+
+from conftest import open_storage
+from storage import SQLiteStorage
+
+# The reminder queries must stay index lookups as the table grows. These tests record the statements
+# the storage methods actually run and check their query plans: claiming walks idx_reminders_remind_time
+# and reads the claim back through idx_reminders_claimed_by, listing walks idx_reminders_user_time, and
+# updates and deletes by id go through the primary key.
+
+USERS = 50
+REMINDERS = 1000
+
+
+def indexes_used(backend, plan):
+    # The index each table access in the plan uses, with None for a full table scan.
+    if backend == 'sqlite':
+        used = []
+        for row in plan:
+            detail = row[3]
+            match = re.search(r'USING (?:COVERING )?INDEX (\w+)', detail)
+            if match:
+                used.append(match.group(1))
+            elif 'INTEGER PRIMARY KEY' in detail:
+                used.append('PRIMARY')
+            elif detail.startswith('SCAN reminders'):
+                used.append(None)
+        return used
+    return [row[5] for row in plan if row[2] == 'reminders']
+
+
+async def explain(store, backend, statement):
+    sql, args = statement
+    if backend == 'sqlite':
+        return indexes_used(backend, await store.fetchall('EXPLAIN QUERY PLAN ' + sql))
+    return indexes_used(backend, await store.fetchall('EXPLAIN ' + sql, args))
+
+
+async def seed(store, backend):
+    now = datetime.now().replace(microsecond=0)
+    await asyncio.gather(*(store.add_reminder(n % USERS, f'reminder {n}', now + timedelta(minutes=n - 10), None, None)
+                           for n in range(REMINDERS)))
+    if backend == 'mariadb':
+        await store.fetchall('ANALYZE TABLE reminders')
+    return now
+
+
+@pytest.fixture
+def traced_storage(backend, tmp_path, monkeypatch):
+    # Opens a store that records every reminders statement it runs, as (sql, args). SQLite statements
+    # are recorded with their arguments filled in, straight from the connections.
+    statements = []
+
+    if backend == 'sqlite':
+        connect = SQLiteStorage.connect
+
+        def traced_connect(self):
+            conn = connect(self)
+            conn.set_trace_callback(lambda sql: statements.append((sql, ())) if 'reminders' in sql else None)
+            return conn
+        monkeypatch.setattr(SQLiteStorage, 'connect', traced_connect)
+
+    def run(scenario):
+        async def main():
+            store = await open_storage(backend, str(tmp_path / 'test.db'))
+            if backend == 'mariadb':
+                for name in ('execute', 'fetchone', 'fetchall'):
+                    def traced(sql, args=(), method=getattr(store, name)):
+                        if 'reminders' in sql:
+                            statements.append((sql, args))
+                        return method(sql, args)
+                    setattr(store, name, traced)
+            try:
+                await scenario(store, statements)
+            finally:
+                await store.close()
+        asyncio.run(main())
+    return run
+
+
+async def run_traced(statements, call):
+    del statements[:]
+    await call
+    found = [statement for statement in statements
+             if re.match(r'\s*(SELECT|UPDATE|DELETE)', statement[0], re.IGNORECASE)]
+    del statements[:]
+    return found
+
+
+def test_claim_uses_indexes(backend, traced_storage):
+    async def scenario(store, statements):
+        now = await seed(store, backend)
+        update, select = await run_traced(statements, store.claim_reminders('worker:1', now, 60, 100))
+        # SQLite picks the rows in a subquery and updates them by rowid, MariaDB in one range scan.
+        used = await explain(store, backend, update)
+        assert 'idx_reminders_remind_time' in used
+        assert None not in used
+        assert await explain(store, backend, select) == ['idx_reminders_claimed_by']
+    traced_storage(scenario)
+
+
+def test_list_reminders_uses_user_time_index(backend, traced_storage):
+    async def scenario(store, statements):
+        now = await seed(store, backend)
+        (first,) = await run_traced(statements, store.list_reminders(1, None, 10))
+        (later,) = await run_traced(statements, store.list_reminders(1, (now, 1), 10))
+        for statement in (first, later):
+            assert await explain(store, backend, statement) == ['idx_reminders_user_time']
+        if backend == 'sqlite':
+            # The index already returns rows in (remind_time, id) order, so nothing is sorted.
+            plan = await store.fetchall('EXPLAIN QUERY PLAN ' + later[0])
+            assert not any('TEMP B-TREE' in row[3] for row in plan)
+    traced_storage(scenario)
+
+
+def test_updates_and_deletes_by_id_use_primary_key(backend, traced_storage):
+    async def scenario(store, statements):
+        now = await seed(store, backend)
+        claimed = await store.claim_reminders('worker:1', now, 60, 3)
+        first, second, third = (row[0] for row in claimed)
+        user_id = claimed[0][1]
+        found = []
+        found += await run_traced(statements, store.take_reminder(first, 'worker:1', now))
+        found += await run_traced(statements, store.complete_reminder(first, 'worker:1'))
+        found += await run_traced(statements, store.reschedule_reminder(second, 'worker:1', now))
+        found += await run_traced(statements, store.cancel_reminder(user_id, third))
+        assert len(found) == 4
+        for statement in found:
+            assert await explain(store, backend, statement) == ['PRIMARY']
+    traced_storage(scenario)
@@ -0,0 +1,152 @@
+import asyncio
+import sqlite3
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+import discord
+from remind import ReminderScheduler, next_fire_time, parse_reminder_time
+from storage import SQLiteStorage
+
+# A store whose reminder operations fail for the ids in `broken`, and a client that records DMs.
+
+
+class FakeStore:
+    def __init__(self, rows, broken=(), claim_error=None):
+        self.rows = rows
+        self.broken = set(broken)
+        self.claim_error = claim_error
+        self.done = []
+
+    async def claim_reminders(self, claim, until, lease_seconds, limit):
+        if self.claim_error:
+            raise self.claim_error
+        rows, self.rows = self.rows, []
+        return [(*row, claim) for row in rows]
+
+    async def take_reminder(self, reminder_id, claim, retry_time):
+        if reminder_id in self.broken:
+            raise sqlite3.OperationalError('database is locked')
+        return True
+
+    async def complete_reminder(self, reminder_id, claim):
+        self.done.append(reminder_id)
+        return True
+
+    async def reschedule_reminder(self, reminder_id, claim, next_time):
+        return await self.complete_reminder(reminder_id, claim)
+
+
+class FakeClient:
+    def __init__(self, error=None):
+        self.sent = []
+        self.error = error
+
+    def get_user(self, user_id):
+        async def send(message):
+            if self.error:
+                raise self.error
+            self.sent.append((user_id, message))
+        return SimpleNamespace(send=send)
+
+
+def test_tick_survives_claim_errors():
+    scheduler = ReminderScheduler()
+    store = FakeStore([], claim_error=sqlite3.OperationalError('database is locked'))
+    asyncio.run(scheduler.tick(store, FakeClient()))
+    assert scheduler.heap == []
+    assert scheduler.next_claim > datetime.now()
+
+
+def test_tick_survives_delivery_errors():
+    due = datetime.now() - timedelta(seconds=1)
+    store = FakeStore([(1, 10, 'first', due, None, None), (2, 20, 'second', due, None, None)], broken={1})
+    client = FakeClient()
+    scheduler = ReminderScheduler()
+    asyncio.run(scheduler.tick(store, client))
+    assert client.sent == [(20, 'DO IT: second')]
+    assert store.done == [2]
+
+
+def test_interval_reminders_keep_their_schedule():
+    # Fired late, an every-2h reminder still lands on its original schedule.
+    remind_time = datetime.now().replace(microsecond=0) - timedelta(seconds=3)
+    assert next_fire_time('interval:7200', remind_time) == remind_time + timedelta(hours=2)
+    # Missed occurrences are skipped.
+    long_ago = remind_time - timedelta(hours=5)
+    assert next_fire_time('interval:7200', long_ago) == long_ago + timedelta(hours=6)
+
+
+def test_interval_reminders_never_fire_in_the_past():
+    remind_time = datetime.now() - timedelta(minutes=3)
+    next_time = next_fire_time('interval:60', remind_time)
+    assert next_time > datetime.now() - timedelta(seconds=1)
+    assert (next_time - remind_time) % timedelta(minutes=1) == timedelta(0)
+
+
+def test_huge_reminder_times_are_rejected():
+    for text in ('99999999 weeks', 'every 99999999 weeks'):
+        with pytest.raises(ValueError):
+            parse_reminder_time(text)
+
+
+# Delivery against a real store: a reminder is only removed once it has been sent.
+
+
+def deliver(tmp_path, scenario):
+    async def main():
+        store = SQLiteStorage(str(tmp_path / 'test.db'))
+        await store.open()
+        try:
+            await scenario(store)
+        finally:
+            await store.close()
+    asyncio.run(main())
+
+
+async def claim_and_fire(store, client):
+    scheduler = ReminderScheduler()
+    await scheduler.tick(store, client)
+    return scheduler
+
+
+def test_cancelled_reminders_are_not_sent(tmp_path):
+    async def scenario(store):
+        reminder_id = await store.add_reminder(1, 'cancel me', datetime.now() - timedelta(seconds=1), None, None)
+        # Claimed into an instance's schedule, then cancelled (possibly through another instance)
+        # before that instance gets round to firing it.
+        scheduler = ReminderScheduler()
+        for row in await store.claim_reminders('other:1', datetime.now(), 60, 10):
+            scheduler.push(row)
+        scheduler.next_claim = datetime.max
+        assert await store.cancel_reminder(1, reminder_id)
+        client = FakeClient()
+        await scheduler.tick(store, client)
+        assert client.sent == []
+    deliver(tmp_path, scenario)
+
+
+def test_failed_sends_keep_the_reminder(tmp_path):
+    async def scenario(store):
+        reminder_id = await store.add_reminder(1, 'retry me', datetime.now() - timedelta(seconds=1), None, None)
+        await claim_and_fire(store, FakeClient(error=discord.HTTPException(SimpleNamespace(status=500, reason='oops'), 'oops')))
+        # Still there under the same id, moved out to be retried, so it can still be cancelled.
+        rows = await store.list_reminders(1, None, 10)
+        assert [row[0] for row in rows] == [reminder_id]
+        assert rows[0][2] > datetime.now()
+        assert await store.cancel_reminder(1, reminder_id)
+    deliver(tmp_path, scenario)
+
+
+def test_sent_reminders_are_completed_or_rescheduled(tmp_path):
+    async def scenario(store):
+        due = datetime.now().replace(microsecond=0) - timedelta(seconds=1)
+        await store.add_reminder(1, 'once', due, None, None)
+        recurring = await store.add_reminder(1, 'hourly', due, 'interval:3600', None)
+        client = FakeClient()
+        await claim_and_fire(store, client)
+        assert sorted(client.sent) == [(1, 'DO IT: hourly'), (1, 'DO IT: once')]
+        rows = await store.list_reminders(1, None, 10)
+        assert [(row[0], row[2]) for row in rows] == [(recurring, due + timedelta(hours=1))]
+    deliver(tmp_path, scenario)
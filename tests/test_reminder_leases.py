@@ -0,0 +1,98 @@
+import asyncio
+import multiprocessing
+import os
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+import remind
+from remind import ReminderScheduler
+from storage import MariaDBStorage
+
+# Several worker processes share one MariaDB and deliver reminders through their own schedulers, the
+# way shard workers do. Every reminder must be delivered exactly once, including the ones claimed by
+# a worker that died before delivering them.
+
+pytestmark = pytest.mark.skipif(not os.getenv('DB_HOST'), reason='DB_HOST is not set')
+
+WORKERS = 4
+REMINDERS = 200
+ABANDONED = 10
+RUN_SECONDS = 8
+
+
+class RecordingClient:
+    def __init__(self, delivered):
+        self.delivered = delivered
+
+    def get_user(self, user_id):
+        client = self
+
+        class User:
+            async def send(self, message):
+                client.delivered.put(message)
+        return User()
+
+
+def run_worker(delivered):
+    # Claim often so reminders whose lease lapsed are picked up within the run.
+    remind.CLAIM_INTERVAL = 1
+
+    async def main():
+        store = MariaDBStorage()
+        await store.open()
+        scheduler = ReminderScheduler()
+        client = RecordingClient(delivered)
+        deadline = time.monotonic() + RUN_SECONDS
+        while time.monotonic() < deadline:
+            await scheduler.tick(store, client)
+            await asyncio.sleep(0.1)
+        await store.close()
+    asyncio.run(main())
+
+
+async def prepare():
+    store = MariaDBStorage()
+    await store.open()
+    await store.execute('DELETE FROM reminders')
+    now = datetime.now().replace(microsecond=0)
+    for n in range(REMINDERS):
+        await store.add_reminder(n, f'reminder {n}', now + timedelta(seconds=n % 4), None, None)
+    # A worker that claimed these and then died. Their one second lease lapses during the run.
+    abandoned = await store.claim_reminders('dead:1', now, 1, ABANDONED)
+    await store.close()
+    return len(abandoned)
+
+
+async def remaining():
+    store = MariaDBStorage()
+    await store.open()
+    row = await store.fetchone('SELECT COUNT(*) FROM reminders')
+    await store.close()
+    return row[0]
+
+
+def test_each_reminder_is_delivered_exactly_once():
+    assert asyncio.run(prepare()) == ABANDONED
+
+    context = multiprocessing.get_context('spawn')
+    delivered = context.Queue()
+    workers = [context.Process(target=run_worker, args=(delivered,)) for _ in range(WORKERS)]
+    for worker in workers:
+        worker.start()
+    messages = []
+    deadline = time.monotonic() + RUN_SECONDS + 30
+    while any(worker.is_alive() for worker in workers) and time.monotonic() < deadline:
+        while not delivered.empty():
+            messages.append(delivered.get())
+        time.sleep(0.1)
+    for worker in workers:
+        worker.join(timeout=5)
+        assert worker.exitcode == 0
+    while not delivered.empty():
+        messages.append(delivered.get())
+
+    assert len(messages) == REMINDERS
+    assert sorted(messages) == sorted(f'DO IT: reminder {n}' for n in range(REMINDERS))
+    assert asyncio.run(remaining()) == 0
@@ -0,0 +1,197 @@
+import asyncio
+import json
+import os
+import signal
+import threading
+import time
+
+from aiohttp import WSMsgType, web
+
+import shards
+
+# Runs the shard supervisor against a fake Discord. The workers are the real main.py (started through
+# tests/shard_worker.py, which points discord.py at the fake), so each one connects its
+# AutoShardedClient with the shards the supervisor gave it. The fake answers the HTTP calls made at
+# login and /gateway/bot, speaks enough of the gateway protocol to get every shard to READY, and
+# records every session: which worker process opened it, the shard it IDENTIFYed as and how it closed.
+
+SHARD_COUNT = 4
+WORKERS = 2
+IDENTIFY_DELAY = 0.3
+# READY is only dispatched to main.py once the shards' guilds have streamed in, which for a bot
+# without guilds is discord.py's guild_ready_timeout of 2 seconds.
+READY_WAIT = 4
+
+BOT_USER = {'id': '1000', 'username': 'exodus2-test', 'discriminator': '0', 'avatar': None, 'bot': True}
+
+
+
+def json_response(data):
+    # discord.py only decodes a response as JSON when its content type is exactly application/json,
+    # without the charset aiohttp's json_response adds.
+    return web.Response(body=json.dumps(data).encode(), content_type='application/json')
+
+
+class FakeDiscord:
+    def __init__(self, crash_shard=None):
+        # The first session IDENTIFYing as crash_shard is closed with 4004 (authentication failed),
+        # which makes discord.py give up and the worker exit with an error.
+        self.crash_shard = crash_shard
+        self.sessions = []
+        self.loop = asyncio.new_event_loop()
+        self.runner = None
+        self.url = None
+
+    async def current_user(self, request):
+        return json_response(BOT_USER)
+
+    async def application(self, request):
+        return json_response({'id': '1000', 'name': 'Exodus2', 'description': '', 'icon': None,
+                                  'bot_public': True, 'bot_require_code_grant': False, 'owner': BOT_USER,
+                                  'verify_key': '', 'flags': 0})
+
+    async def gateway_bot(self, request):
+        return json_response({'url': self.url.replace('http', 'ws', 1) + '/gateway/0/', 'shards': SHARD_COUNT,
+                                  'session_start_limit': {'total': 1000, 'remaining': 1000,
+                                                          'reset_after': 0, 'max_concurrency': 1}})
+
+    async def gateway(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        await ws.send_json({'op': 10, 'd': {'heartbeat_interval': 45000}})
+        # discord.py heartbeats as soon as it gets HELLO, before it IDENTIFYs.
+        identify = await ws.receive_json()
+        while identify['op'] == 1:
+            await ws.send_json({'op': 11})
+            identify = await ws.receive_json()
+        assert identify['op'] == 2
+        shard_id, shard_count = identify['d']['shard']
+        session = {'pid': int(request.match_info['pid']), 'shard_id': shard_id, 'shard_count': shard_count,
+                   'identified_at': time.monotonic(), 'ready_at': None, 'close_code': None}
+        self.sessions.append(session)
+        if shard_id == self.crash_shard:
+            self.crash_shard = None
+            await ws.close(code=4004, message=b'Authentication failed.')
+            session['close_code'] = 4004
+            return ws
+        await ws.send_json({'op': 0, 't': 'READY', 's': 1, 'd': {
+            'v': 10, 'user': BOT_USER, 'guilds': [], 'session_id': f'{session["pid"]}-{shard_id}',
+            'resume_gateway_url': self.url.replace('http', 'ws', 1) + f'/gateway/{session["pid"]}/',
+            'shard': [shard_id, shard_count], 'application': {'id': '1000', 'flags': 0}}})
+        session['ready_at'] = time.monotonic()
+        async for message in ws:
+            if message.type == WSMsgType.TEXT and json.loads(message.data)['op'] == 1:
+                await ws.send_json({'op': 11})
+        session['close_code'] = ws.close_code
+        return ws
+
+    async def start_server(self):
+        app = web.Application()
+        app.router.add_get('/api/v10/users/@me', self.current_user)
+        app.router.add_get('/api/v10/oauth2/applications/@me', self.application)
+        app.router.add_get('/api/v10/gateway/bot', self.gateway_bot)
+        app.router.add_get('/gateway/{pid}/', self.gateway)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = self.runner.addresses[0][1]
+        self.url = f'http://127.0.0.1:{port}'
+
+    def __enter__(self):
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        asyncio.run_coroutine_threadsafe(self.start_server(), self.loop).result()
+        return self
+
+    def __exit__(self, *exc):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+def test_split_shards_covers_every_shard_once():
+    for shard_count in range(1, 20):
+        for workers in range(1, shard_count + 1):
+            groups = shards.split_shards(shard_count, workers)
+            assert len(groups) == workers
+            assert all(groups)
+            assert sorted(shard_id for group in groups for shard_id in group) == list(range(shard_count))
+
+
+def test_recommended_shard_count_reads_the_gateway(monkeypatch):
+    with FakeDiscord() as discord:
+        monkeypatch.setattr(shards, 'gateway_url', discord.url + '/api/v10/gateway/bot')
+        assert shards.recommended_shard_count('test') == SHARD_COUNT
+
+
+def test_supervisor_runs_main_as_shard_workers(monkeypatch, tmp_path, capfd):
+    groups = shards.split_shards(SHARD_COUNT, WORKERS)
+    # The first worker crashes on its last shard and is restarted.
+    with FakeDiscord(crash_shard=groups[0][-1]) as discord:
+        monkeypatch.chdir(tmp_path)
+        monkeypatch.setattr(shards, 'gateway_url', discord.url + '/api/v10/gateway/bot')
+        monkeypatch.setattr(shards, 'worker_script', os.path.join(os.path.dirname(__file__), 'shard_worker.py'))
+        monkeypatch.setattr(shards, 'IDENTIFY_DELAY', IDENTIFY_DELAY)
+        monkeypatch.setattr(shards, 'load_dotenv', lambda: None)
+        monkeypatch.delenv('SHARD_COUNT', raising=False)
+        monkeypatch.delenv('SHARD_IDS', raising=False)
+        monkeypatch.setenv('SHARD_WORKERS', str(WORKERS))
+        monkeypatch.setenv('DISCORD_TOKEN', 'test')
+        monkeypatch.setenv('FAKE_DISCORD_URL', discord.url)
+        monkeypatch.setenv('STORAGE_BACKEND', 'sqlite')
+        monkeypatch.setenv('SQLITE_PATH', str(tmp_path / 'exodus2.db'))
+
+        def running():
+            # Every shard connected, the crashed one twice, and all of them READY for long enough
+            # that main.py's on_ready has run.
+            live = [session for session in discord.sessions if session['close_code'] is None]
+            return (sorted(session['shard_id'] for session in discord.sessions) ==
+                    sorted(list(range(SHARD_COUNT)) + groups[0])
+                    and len(live) == SHARD_COUNT
+                    and all(session['ready_at'] and time.monotonic() - session['ready_at'] > READY_WAIT
+                            for session in live))
+
+        # Stop the second worker the way docker or an operator would. It shuts down cleanly, and the
+        # supervisor then stops the rest of the bot instead of restarting it.
+        def stop_a_worker():
+            deadline = time.monotonic() + 60
+            while not running() and time.monotonic() < deadline:
+                time.sleep(0.1)
+            if running():
+                worker_pid = next(session['pid'] for session in discord.sessions if session['shard_id'] == groups[1][0])
+                os.kill(worker_pid, signal.SIGTERM)
+            else:
+                os.kill(os.getpid(), signal.SIGTERM)
+
+        handlers = signal.getsignal(signal.SIGTERM), signal.getsignal(signal.SIGINT)
+        threading.Thread(target=stop_a_worker, daemon=True).start()
+        try:
+            shards.main()
+        finally:
+            signal.signal(signal.SIGTERM, handlers[0])
+            signal.signal(signal.SIGINT, handlers[1])
+        # Give the fake gateway a moment to see the last sessions close.
+        time.sleep(0.5)
+        sessions = list(discord.sessions)
+
+    output = capfd.readouterr().out
+    assert f'Worker for shards {groups[1]} shut down, stopping the other workers' in output
+    assert output.count('We have logged in as exodus2-test') == WORKERS
+
+    assert all(session['shard_count'] == SHARD_COUNT for session in sessions)
+    by_worker = {}
+    for session in sessions:
+        by_worker.setdefault(session['pid'], []).append(session['shard_id'])
+    # Each worker process connected exactly the shards of one group: both starts of the first worker
+    # and the one start of the second.
+    assert sorted(by_worker.values()) == sorted([groups[0], groups[0], groups[1]])
+    crashed = [session for session in sessions if session['close_code'] == 4004]
+    assert [session['shard_id'] for session in crashed] == [groups[0][-1]]
+    # Every other session was closed normally by a worker shutting down on SIGTERM.
+    assert all(session['close_code'] == 1000 for session in sessions
+               if session['pid'] != crashed[0]['pid'])
+
+    # Workers are started IDENTIFY_DELAY apart for every shard the previous one owns.
+    first = {}
+    for session in sessions:
+        first.setdefault(session['shard_id'], session['identified_at'])
+    assert first[groups[1][0]] - first[groups[0][0]] >= IDENTIFY_DELAY * len(groups[0]) / 2
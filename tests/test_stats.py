@@ -0,0 +1,124 @@
+import asyncio
+import os
+import signal
+
+import lifecycle
+import stats
+
+# Game results are written behind in batches. A batch that fails is merged back into `pending` and
+# written by a later flush, and that must keep working even when other flushes evicted player
+# stats from memory in the meantime.
+
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+
+
+class FakeInteraction:
+    def __init__(self, user_id, guild_id=1):
+        self.user = FakeUser(user_id)
+        self.guild_id = guild_id
+
+
+class FakeStore:
+    def __init__(self):
+        self.written = []
+        self.gate = None
+        self.fail = False
+
+    async def get_game_stats(self, guild_id, user_id, game):
+        return None
+
+    async def top_players(self, guild_id, game, limit):
+        return []
+
+    async def upsert_game_stats(self, rows):
+        if self.gate:
+            gate, self.gate = self.gate, None
+            fail, self.fail = self.fail, False
+            await gate.wait()
+            if fail:
+                raise ConnectionError('lost connection')
+        self.written.extend(rows)
+
+
+def test_failed_batch_is_retried_after_eviction(monkeypatch):
+    store = FakeStore()
+
+    async def get_storage():
+        return store
+    monkeypatch.setattr(stats, 'get_storage', get_storage)
+    monkeypatch.setattr(stats, 'RECORD_CACHE_SIZE', 1)
+    monkeypatch.setattr(stats, 'records', stats.OrderedDict())
+    monkeypatch.setattr(stats, 'pending', {})
+    monkeypatch.setattr(stats, 'writing', [])
+    monkeypatch.setattr(stats, 'boards', {})
+
+    async def main():
+        await stats.record(FakeInteraction(1), 'poker', 'win')
+        # The first flush hangs on the database and then fails.
+        store.gate, store.fail = asyncio.Event(), True
+        gate = store.gate
+        slow_flush = asyncio.create_task(stats.flush_pending())
+        await asyncio.sleep(0)
+
+        # Meanwhile player 1 wins again and other players finish games, and a second flush
+        # succeeds and trims the record cache.
+        await stats.record(FakeInteraction(1), 'poker', 'win')
+        await stats.record(FakeInteraction(2), 'poker', 'loss')
+        await stats.record(FakeInteraction(3), 'poker', 'tie')
+        await stats.flush_pending()
+        assert (1, 1, 'poker') in stats.records
+
+        gate.set()
+        await slow_flush
+        assert stats.pending == {(1, 1, 'poker'): [1, 0, 0, 2, 2]}
+        await stats.flush_pending()
+    asyncio.run(main())
+
+    assert sorted(store.written) == [
+        (1, 1, 'poker', 1, 0, 0, 2, 2),
+        (1, 1, 'poker', 1, 0, 0, 2, 2),
+        (1, 2, 'poker', 0, 1, 0, 0, 0),
+        (1, 3, 'poker', 0, 0, 1, 0, 0),
+    ]
+    assert stats.pending == {}
+    assert stats.writing == []
+    stats_1 = stats.records[(1, 1, 'poker')]
+    assert (stats_1.wins, stats_1.streak, stats_1.best_streak) == (2, 2, 2)
+
+
+def test_sigterm_writes_pending_results(monkeypatch, tmp_path):
+    store = FakeStore()
+
+    async def get_storage():
+        return store
+    monkeypatch.setattr(stats, 'get_storage', get_storage)
+    monkeypatch.setattr(stats, 'records', stats.OrderedDict())
+    monkeypatch.setattr(stats, 'pending', {})
+    monkeypatch.setattr(stats, 'writing', [])
+    monkeypatch.setattr(stats, 'boards', {})
+    monkeypatch.setattr(lifecycle, 'draining', False)
+    monkeypatch.setattr(lifecycle, 'snapshot_path', str(tmp_path / 'warm_state.json.gz'))
+
+    async def main():
+        stopped = asyncio.Event()
+
+        # What main.py does on a signal, less the Discord client.
+        async def shutdown():
+            await lifecycle.drain()
+            stopped.set()
+        lifecycle.handle_signals(shutdown)
+
+        await stats.record(FakeInteraction(1), 'blackjack', 'win')
+        await stats.record(FakeInteraction(2), 'blackjack', 'loss')
+        os.kill(os.getpid(), signal.SIGTERM)
+        await asyncio.wait_for(stopped.wait(), timeout=5)
+    asyncio.run(main())
+
+    assert sorted(store.written) == [
+        (1, 1, 'blackjack', 1, 0, 0, 1, 1),
+        (1, 2, 'blackjack', 0, 1, 0, 0, 0),
+    ]
+    assert stats.pending == {}
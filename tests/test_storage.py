@@ -0,0 +1,151 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+from storage import Storage
+
+
+def test_storage_is_abstract():
+    with pytest.raises(TypeError):
+        Storage()
+
+
+def test_users(with_storage):
+    async def scenario(store):
+        assert await store.get_user(1) is None
+        await store.set_user_location(1, 'Paris, France')
+        await store.set_user_unit(1, 'F')
+        await store.set_user_timezone(1, 'Europe/Paris')
+        await store.set_user_unit(2, 'K')
+        assert await store.get_user(1) == ('Paris, France', 'F', 'Europe/Paris')
+        assert await store.get_user(2) == (None, 'K', None)
+        await store.set_user_location(1, 'Lyon, France')
+        assert await store.get_user(1) == ('Lyon, France', 'F', 'Europe/Paris')
+    with_storage(scenario)
+
+
+def test_claim_complete_reschedule(with_storage):
+    async def scenario(store):
+        now = datetime.now().replace(microsecond=0)
+        due = await store.add_reminder(1, 'due', now - timedelta(seconds=5), None, None)
+        recurring = await store.add_reminder(1, 'recurring', now - timedelta(seconds=5), 'interval:3600', 'UTC')
+        later = await store.add_reminder(1, 'later', now + timedelta(hours=1), None, None)
+
+        rows = await store.claim_reminders('a:1', now, 60, 10)
+        assert sorted(row[0] for row in rows) == [due, recurring]
+        assert all(row[6] == 'a:1' for row in rows)
+        # Leased reminders aren't claimed again until the lease expires.
+        assert await store.claim_reminders('b:1', now, 60, 10) == []
+
+        # Only the holder of the claim can complete or reschedule.
+        assert not await store.complete_reminder(due, 'b:1')
+        assert await store.complete_reminder(due, 'a:1')
+        assert not await store.complete_reminder(due, 'a:1')
+        assert await store.reschedule_reminder(recurring, 'a:1', now + timedelta(hours=2))
+
+        remaining = await store.list_reminders(1, None, 10)
+        assert [(row[0], row[2]) for row in remaining] == [(later, now + timedelta(hours=1)),
+                                                          (recurring, now + timedelta(hours=2))]
+        # A rescheduled reminder is free to be claimed again when it comes due.
+        rows = await store.claim_reminders('b:2', now + timedelta(hours=3), 60, 10)
+        assert sorted(row[0] for row in rows) == sorted([later, recurring])
+    with_storage(scenario)
+
+
+def test_claim_batch_limit(with_storage):
+    async def scenario(store):
+        now = datetime.now().replace(microsecond=0)
+        for n in range(5):
+            await store.add_reminder(1, f'r{n}', now - timedelta(minutes=n), None, None)
+        first = await store.claim_reminders('a:1', now, 60, 3)
+        second = await store.claim_reminders('a:2', now, 60, 3)
+        assert len(first) == 3 and len(second) == 2
+        # The oldest are claimed first.
+        assert sorted(row[2] for row in first) == ['r2', 'r3', 'r4']
+    with_storage(scenario)
+
+
+def test_list_reminders_pages(with_storage):
+    async def scenario(store):
+        start = datetime.now().replace(microsecond=0) + timedelta(hours=1)
+        # Three reminders share every time, so pages have to break ties on id.
+        ids = [await store.add_reminder(1, f'r{n}', start + timedelta(minutes=n // 3), None, None) for n in range(25)]
+        await store.add_reminder(2, 'someone else', start, None, None)
+
+        seen, after = [], None
+        while True:
+            page = await store.list_reminders(1, after, 10)
+            if not page:
+                break
+            seen += [row[0] for row in page]
+            after = (page[-1][2], page[-1][0])
+        assert seen == ids
+
+        assert await store.cancel_reminder(1, ids[0])
+        assert not await store.cancel_reminder(1, ids[0])
+        assert not await store.cancel_reminder(1, 999999)
+        assert [row[0] for row in await store.list_reminders(1, None, 2)] == ids[1:3]
+    with_storage(scenario)
+
+
+def test_cancel_only_own_reminders(with_storage):
+    async def scenario(store):
+        reminder_id = await store.add_reminder(1, 'mine', datetime.now() + timedelta(hours=1), None, None)
+        assert not await store.cancel_reminder(2, reminder_id)
+        assert await store.cancel_reminder(1, reminder_id)
+    with_storage(scenario)
+
+
+def test_quotes(with_storage):
+    async def scenario(store):
+        await store.seed_quotes([('<alice> the coffee machine is broken again', 'alice'),
+                                 ('<bob> who broke the build', 'bob'),
+                                 ('<alice> linux on the desktop this year', 'alice')])
+        # Seeding only fills an empty table.
+        await store.seed_quotes([('<carol> never stored', 'carol')])
+        quote_id = await store.add_quote('<carol> coffee first, questions later', 'carol', 42)
+
+        found = [text for _, text in await store.search_quotes('coffee', 5)]
+        assert sorted(found) == ['<alice> the coffee machine is broken again', '<carol> coffee first, questions later']
+        assert await store.search_quotes('zebra', 5) == []
+        assert [row[0] for row in await store.quotes_by_author('carol', 5)] == [quote_id]
+        assert len(await store.quotes_by_author('alice', 5)) == 2
+        assert await store.max_quote_id() == quote_id
+        picked = await store.random_quotes(3)
+        assert 1 <= len(picked) <= 3 and len(set(picked)) == len(picked)
+        assert set(picked) <= {'<alice> the coffee machine is broken again', '<bob> who broke the build',
+                               '<alice> linux on the desktop this year', '<carol> coffee first, questions later'}
+    with_storage(scenario)
+
+
+def test_concurrent_seeding_inserts_once(with_storage):
+    # Shard workers starting together all seed the quotes table.
+    async def scenario(store):
+        seed = [(f'<dave> quote {n}', 'dave') for n in range(50)]
+        await asyncio.gather(*(store.seed_quotes(seed) for _ in range(4)))
+        assert len(await store.quotes_by_author('dave', 500)) == len(seed)
+    with_storage(scenario)
+
+
+def test_search_quotes_ignores_query_syntax(with_storage):
+    async def scenario(store):
+        await store.add_quote('<dave> "quoted" AND (parens)', 'dave', 1)
+        assert len(await store.search_quotes('"quoted" AND (parens', 5)) == 1
+    with_storage(scenario)
+
+
+def test_upsert_game_stats(with_storage):
+    async def scenario(store):
+        assert await store.get_game_stats(1, 10, 'poker') is None
+        await store.upsert_game_stats([(1, 10, 'poker', 2, 1, 0, 1, 2), (1, 11, 'poker', 5, 0, 0, 5, 5),
+                                       (1, 12, 'poker', 1, 0, 0, 1, 1), (2, 10, 'poker', 9, 0, 0, 9, 9)])
+        # Counts add up, the current streak is replaced and the best streak never goes down.
+        await store.upsert_game_stats([(1, 10, 'poker', 3, 0, 1, 4, 4), (1, 11, 'poker', 0, 1, 0, 0, 3)])
+        assert await store.get_game_stats(1, 10, 'poker') == (5, 1, 1, 4, 4)
+        assert await store.get_game_stats(1, 11, 'poker') == (5, 1, 0, 0, 5)
+        top = await store.top_players(1, 'poker', 2)
+        assert [row[1] for row in top] == [5, 5]
+        assert {row[0] for row in top} == {10, 11}
+        assert await store.top_players(1, 'blackjack', 10) == []
+    with_storage(scenario)
@@ -0,0 +1,94 @@
+import time
+from collections import OrderedDict
+
+# Command cooldowns. A command can have a per-user, per-guild and global token bucket, each given as
+# (capacity, period in seconds): the bucket holds up to `capacity` uses and refills completely over
+# `period`. Commands that aren't listed are not throttled. Subcommands use their full name.
+
+limits = {
+    'weather': {'user': (3, 30), 'guild': (20, 60), 'global': (120, 60)},
+    'setlocation': {'user': (3, 60)},
+    'setunit': {'user': (3, 60)},
+    'remind': {'user': (5, 60), 'guild': (30, 60)},
+    'settimezone': {'user': (3, 60)},
+    'reminders list': {'user': (5, 30)},
+    'reminders cancel': {'user': (10, 60)},
+    'quotes add': {'user': (3, 60), 'guild': (10, 60)},
+    'quotes search': {'user': (5, 30), 'global': (60, 60)},
+    'quotes author': {'user': (5, 30), 'global': (60, 60)},
+    'blackjack': {'user': (2, 30)},
+    'poker': {'user': (2, 30)},
+    'roulette': {'user': (2, 30)},
+}
+
+# One set of buckets per command and scope. A bucket is just (tokens, last update) keyed by the
+# user or guild id. Tokens are refilled lazily when the bucket is next looked at, and since a bucket
+# left idle for a whole period is full again, and a full bucket behaves exactly like a missing one,
+# idle buckets are evicted. The dict is kept in least recently used order so eviction only ever
+# looks at the oldest entries.
+
+
+class BucketSet:
+    __slots__ = ('capacity', 'period', 'rate', 'buckets')
+
+    def __init__(self, capacity, period):
+        self.capacity = capacity
+        self.period = period
+        self.rate = capacity / period
+        self.buckets = OrderedDict()
+
+    def tokens(self, key, now):
+        entry = self.buckets.get(key)
+        if entry is None:
+            return self.capacity
+        tokens, stamp = entry
+        return min(self.capacity, tokens + (now - stamp) * self.rate)
+
+    def retry_after(self, tokens):
+        return (1 - tokens) / self.rate
+
+    def take(self, key, tokens, now):
+        self.buckets[key] = (tokens - 1, now)
+        self.buckets.move_to_end(key)
+
+    def evict(self, now):
+        while self.buckets:
+            key, (tokens, stamp) = next(iter(self.buckets.items()))
+            if now - stamp < self.period:
+                break
+            del self.buckets[key]
+
+
+bucket_sets = {(command, scope): BucketSet(*limit)
+               for command, scopes in limits.items() for scope, limit in scopes.items()}
+
+# Check an interaction against its command's buckets. Returns 0 and uses up a token from each
+# bucket if it may go ahead, otherwise the number of seconds until it may. Nothing is taken from
+# any bucket when one of them is empty.
+
+
+def check(interaction):
+    command = interaction.command
+    scopes = limits.get(command.qualified_name) if command else None
+    if not scopes:
+        return 0
+    now = time.monotonic()
+    ids = {'user': interaction.user.id, 'guild': interaction.guild_id, 'global': 0}
+    wait = 0
+    pending = []
+    for scope in scopes:
+        key = ids[scope]
+        if key is None:
+            # Direct messages have no guild.
+            continue
+        buckets = bucket_sets[(command.qualified_name, scope)]
+        buckets.evict(now)
+        tokens = buckets.tokens(key, now)
+        if tokens < 1:
+            wait = max(wait, buckets.retry_after(tokens))
+        pending.append((buckets, key, tokens))
+    if wait:
+        return wait
+    for buckets, key, tokens in pending:
+        buckets.take(key, tokens, now)
+    return 0
@@ -1,19 +1,22 @@
 import discord
 import random
 import aiohttp
-import aiomysql
 import logging
 import re
 import asyncio
 import os
 import sys
 import json
+import time
 import urllib.parse
 import dotenv
+import lifecycle
+from collections import OrderedDict
 from discord import app_commands
 from discord.ext import tasks, commands
 from dotenv import load_dotenv
 from opencage.geocoder import OpenCageGeocode
+from storage import get_storage
 
 load_dotenv()
 
@@ -26,52 +29,101 @@ intents.members = True
 client = discord.Client(intents=intents)
 tree = app_commands.CommandTree(client)
 
-async def connect_to_db():
-    pool = await aiomysql.create_pool(
-        host=os.getenv('DB_HOST'),
-        port=3306,
-        user=os.getenv('DB_USER'),
-        password=os.getenv('DB_PASSWORD'),
-        db=os.getenv('DB_DATABASE'),
-        autocommit=True
-    )
-    connection = await pool.acquire()
-    return pool, connection
-
 openweathermap_api_key = os.getenv('OPENWEATHERMAP_API_KEY')
 opencage_api_key = os.getenv('OPENCAGE_API_KEY')
 
+# API endpoints. Both can be overridden, which lets the load benchmark point the bot at local stand-ins.
+openweathermap_api_url = os.getenv('OPENWEATHERMAP_API_URL', 'http://api.openweathermap.org/data/2.5/weather')
+opencage_api_url = os.getenv('OPENCAGE_API_URL')
+
+def opencage_geocoder():
+    geocoder = OpenCageGeocode(opencage_api_key)
+    if opencage_api_url:
+        geocoder.url = opencage_api_url
+    return geocoder
+
+# In-memory caches. Geocoding results rarely change and current weather is kept for a few minutes.
+# Entries are stamped with wall-clock time so they stay valid when saved across a restart.
+#
+# User profiles (location and unit) are only cached briefly. The cache is per process: a change is
+# invalidated in the worker that made it, but other shard workers keep serving the old profile until
+# their entry expires, so PROFILE_TTL is how stale a profile may be in the rest of the cluster. It
+# still saves the lookup when one user runs several commands in a row.
+
+GEOCODE_TTL = 7 * 24 * 3600
+WEATHER_TTL = 600
+PROFILE_TTL = 10
+CACHE_SIZE = 10000
+
+class TimedCache:
+    def __init__(self, ttl, size=CACHE_SIZE):
+        self.ttl = ttl
+        self.size = size
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None or time.time() - entry[0] > self.ttl:
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def set(self, key, value):
+        self.entries[key] = (time.time(), value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        self.entries.pop(key, None)
+
+    def dump(self):
+        return [[key, stamp, value] for key, (stamp, value) in self.entries.items()]
+
+    def load(self, items):
+        for key, stamp, value in items:
+            self.entries[key] = (stamp, value)
+
+geocode_cache = TimedCache(GEOCODE_TTL)
+weather_cache = TimedCache(WEATHER_TTL)
+profile_cache = TimedCache(PROFILE_TTL)
+
+# Keep the caches when this module is hot reloaded.
+reload_keep = ('geocode_cache', 'weather_cache', 'profile_cache')
+
+def dump_caches():
+    return {'geocode': geocode_cache.dump(), 'weather': weather_cache.dump(), 'profiles': profile_cache.dump()}
+
+def load_caches(data):
+    geocode_cache.load(data['geocode'])
+    weather_cache.load(data['weather'])
+    profile_cache.load(data['profiles'])
+
+lifecycle.register_state('weather', dump_caches, load_caches)
+
 # Definitions for the weather database.
 
-async def set_user_location(user_id, location, pool):
-    async with pool.acquire() as conn:
-        async with conn.cursor() as cur:
-            await cur.execute('UPDATE users SET location = %s WHERE id = %s', (location, user_id))
-            if cur.rowcount == 0:
-                await cur.execute('INSERT INTO users (id, location) VALUES (%s, %s)', (user_id, location))
-        await conn.commit()
-
-async def set_user_unit(user_id, unit, pool):
-    async with pool.acquire() as conn:
-        async with conn.cursor() as cur:
-            await cur.execute('UPDATE users SET unit = %s WHERE id = %s', (unit, user_id))
-            if cur.rowcount == 0:
-                await cur.execute('INSERT INTO users (id, unit) VALUES (%s, %s)', (user_id, unit))
-        await conn.commit()
-
-async def get_user_location(user_id, pool):
-    async with pool.acquire() as conn:
-        async with conn.cursor() as cur:
-            await cur.execute("SELECT location FROM users WHERE id = %s", (user_id,))
-            result = await cur.fetchone()
-            return result[0] if result else None
-
-async def get_user_unit(user_id, pool):
-    async with pool.acquire() as conn:
-        async with conn.cursor() as cur:
-            await cur.execute("SELECT unit FROM users WHERE id = %s", (user_id,))
-            result = await cur.fetchone()
-            return result[0] if result else None
+async def set_user_location(user_id, location, store):
+    await store.set_user_location(user_id, location)
+    profile_cache.invalidate(user_id)
+
+async def set_user_unit(user_id, unit, store):
+    await store.set_user_unit(user_id, unit)
+    profile_cache.invalidate(user_id)
+
+async def get_user_profile(user_id, store):
+    profile = profile_cache.get(user_id)
+    if profile is None:
+        user = await store.get_user(user_id)
+        profile = [user[0], user[1]] if user else [None, None]
+        profile_cache.set(user_id, profile)
+    return profile
+
+async def get_user_location(user_id, store):
+    return (await get_user_profile(user_id, store))[0]
+
+async def get_user_unit(user_id, store):
+    return (await get_user_profile(user_id, store))[1]
         
 class GeocodingService:
     async def get_coordinates(self, location):
@@ -95,13 +147,18 @@ class GeocodingService:
             return "Unable to determine coordinates for the location."
 
     async def fetch_coordinates_from_opencage(self, location):
-        geocoder = OpenCageGeocode(opencage_api_key)
+        cached = geocode_cache.get(f'coordinates:{location}')
+        if cached is not None:
+            return cached
+        geocoder = opencage_geocoder()
         try:
-            results = geocoder.geocode(location)
+            results = await asyncio.to_thread(geocoder.geocode, location)
 
             if results and 'geometry' in results[0]:
                 geometry = results[0]['geometry']
-                return geometry['lat'], geometry['lng']
+                coordinates = [geometry['lat'], geometry['lng']]
+                geocode_cache.set(f'coordinates:{location}', coordinates)
+                return coordinates
             else:
                 print(f"No results found in OpenCage response for {location}")
             return None
@@ -137,10 +194,13 @@ async def weather(interaction, location: str = None, unit: str = None):
         ]
 
     async def get_city_details(location):
-        geocoder = OpenCageGeocode(opencage_api_key)
+        geocoder = opencage_geocoder()
         try:
             await interaction.response.defer()
-            results = geocoder.geocode(location)
+            cached = geocode_cache.get(location)
+            if cached is not None:
+                return cached
+            results = await asyncio.to_thread(geocoder.geocode, location)
             print(f"OpenCage Response for {location}: {results}")
 
             results = filter_geonames(results)
@@ -154,13 +214,15 @@ async def weather(interaction, location: str = None, unit: str = None):
                 print(f"DEBUG: state_province: {state_province}, country: {country}")
 
                 # Return a dictionary with location information
-                return {
+                city_details = {
                     'city': components.get('place'), 
                     'state_province': state_province, 
                     'country': country,
                     'lng': results[0]['geometry']['lng'],
                     'lat': results[0]['geometry']['lat']
                 }
+                geocode_cache.set(location, city_details)
+                return city_details
             else:
                 print(f"No results found in OpenCage response for {city}")
                 return {}
@@ -175,11 +237,11 @@ async def weather(interaction, location: str = None, unit: str = None):
 
     async with aiohttp.ClientSession() as session:
         # Connect to the database
-        pool, connection = await connect_to_db()
+        store = await get_storage()
 
         try:
             # If unit is not provided, retrieve the user's preferred unit from the database
-            unit = await get_user_unit(interaction.user.id, pool)
+            unit = await get_user_unit(interaction.user.id, store)
             print(f"DEBUG: Unit retrieved from the database: {unit}")
 
             if not unit:
@@ -189,7 +251,7 @@ async def weather(interaction, location: str = None, unit: str = None):
             # Check if the location is not provided
             if location is None:
                 # Retrieve the user's location from the database
-                location = await get_user_location(interaction.user.id, pool)
+                location = await get_user_location(interaction.user.id, store)
                 print(f"DEBUG: Location retrieved from the database: {location}")
 
                 if not location:
@@ -197,9 +259,6 @@ async def weather(interaction, location: str = None, unit: str = None):
                     return
 
         finally:
-            # Release the database connection
-            await pool.release(connection)
-
             # Split the input into parts (city, state_province, country)
             location_parts = [part.strip() for part in location.split(',')]
 
@@ -232,13 +291,18 @@ async def weather(interaction, location: str = None, unit: str = None):
 
     async with aiohttp.ClientSession() as session:
         try:
-            url = f'http://api.openweathermap.org/data/2.5/weather?q={full_location}&appid={openweathermap_api_key}&units=metric'
+            url = f'{openweathermap_api_url}?q={full_location}&appid={openweathermap_api_key}&units=metric'
             print(f"DEBUG: OpenWeatherMap API URL: {url}")
 
-            async with session.get(url) as response:
-                data = await response.json()
+            data = weather_cache.get(full_location)
+            if data is None:
+                async with session.get(url) as response:
+                    data = await response.json()
+
+                    print(f"DEBUG: OpenWeatherMap API Response: {data}")
 
-                print(f"DEBUG: OpenWeatherMap API Response: {data}")
+                if data and data.get('cod') == 200:
+                    weather_cache.set(full_location, data)
 
             if data and data.get('cod') == 200:
                 temp_celsius = data['main']['temp']
@@ -263,27 +327,25 @@ async def weather(interaction, location: str = None, unit: str = None):
 
 # Setlocation command.
             
-# Sets a location and stores this information in a mariadb database.
+# Sets a location and stores this information in the database.
 
 @tree.command(name='setlocation', description='Set your preferred location')
 async def setlocation(interaction, location: str, state_province: str = None, country: str = None):
-    pool, connection = await connect_to_db()
+    store = await get_storage()
 
     # Check if the user's location is already set to the provided location
-    current_location = await get_user_location(interaction.user.id, pool)
+    current_location = await get_user_location(interaction.user.id, store)
     if current_location == f"{location}, {state_province}, {country}" or current_location == f"{location}, {country}":
-        await pool.release(connection)
         await interaction.response.send_message('Your location is already set to this location.')
         return
 
     full_location = f"{location}, {state_province}, {country}" if state_province else f"{location}, {country}"
-    await set_user_location(interaction.user.id, full_location, pool)
-    await pool.release(connection)
+    await set_user_location(interaction.user.id, full_location, store)
     await interaction.response.send_message(f'Your location has been set to {location}.')
 
 # Setunit command
 
-# Set preferred units for the weather command. Stores this information in a mariadb database.
+# Set preferred units for the weather command. Stores this information in the database.
 
 @tree.command(name='setunit', description='Set your preferred units')
 async def setunit(interaction, *, unit: str):
@@ -294,15 +356,13 @@ async def setunit(interaction, *, unit: str):
         await interaction.response.send_message('Invalid unit. Please specify either `C` for Celsius, `F` for Fahrenheit, or `K` for Kelvin.')
         return
 
-    pool, connection = await connect_to_db()
+    store = await get_storage()
 
     # Check if the user's preferred unit is already set to the specified unit
-    current_unit = await get_user_unit(interaction.user.id, pool)
+    current_unit = await get_user_unit(interaction.user.id, store)
     if current_unit == unit.upper():
-        await pool.release(connection)
         await interaction.response.send_message(f'Your preferred temperature unit is already set to {unit.upper()}.')
         return
 
-    await set_user_unit(interaction.user.id, unit.upper(), pool)
-    await pool.release(connection)
+    await set_user_unit(interaction.user.id, unit.upper(), store)
     await interaction.response.send_message(f'Your preferred temperature unit has been set to {unit.upper()}.')
\ No newline at end of file